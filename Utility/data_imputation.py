@@ -8,6 +8,10 @@ import load_files as lf
 import wrangling
 import numpy as np
 import pandas as pd
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 
 def check_monotonicity(x, epsilon = 3):
@@ -33,16 +37,31 @@ def check_monotonicity(x, epsilon = 3):
 
 def calc_monotonicity(data, horizon = 5, epsilon = 3):
     """
-    Calculates the monotonicity within a sliding window.
-    Adds columns 'Window' and 'Monotonicity' to data.
+    Calculates the monotonicity within a sliding window of the rows
+    (index-horizon)-(index+horizon), as check_monotonicity does for a single window.
+    Adds column 'Monotonicity' to data.
     """
     data = data.copy()
+    n = len(data)
 
-    # Window column is a tuple of (index-horizon)-(index+horizon)
-    data['Window'] = data.apply(lambda x: [data['Value'][x.name-horizon: x.name + horizon + 1]], axis=1)
-    
-    # Calculates monotonicity based on check_monotonicity()
-    data['Monotonicity'] = data.apply(lambda x: check_monotonicity(x['Window'], epsilon = epsilon), axis = 1)
+    # Window bounds follow slicing of the Value column, including its wrap-around
+    # for negative starts at the first rows
+    positions = np.arange(n)
+    start = positions - horizon
+    start = np.clip(np.where(start < 0, start + n, start), 0, n)
+    stop = np.minimum(positions + horizon + 1, n)
+    n_diffs = np.maximum(stop - start - 1, 0)
+
+    # Number of non-negative first differences within each window by prefix sums
+    with np.errstate(invalid="ignore"):
+        positive = np.diff(data['Value'].values.astype(float)) >= 0
+    prefix = np.concatenate([[0], np.cumsum(positive)])
+    positives = np.where(n_diffs > 0, prefix[np.maximum(stop - 1, 0)] - prefix[np.minimum(start, n - 1)], 0)
+    negatives = n_diffs - positives
+
+    # Decreasing (-1), increasing (1) or extremum (0), as check_monotonicity
+    data['Monotonicity'] = np.where(negatives >= n_diffs - epsilon, -1,
+                                    np.where(positives >= n_diffs - epsilon, 1, 0))
 
     return data
 
@@ -98,6 +117,93 @@ def fill_flow_apply(row, flow_data, level_data, on_level, epsilon = 0.01):
             return np.mean(flow_values)
 
 
+class similar_level_index:
+    """
+    Index over the non-increasing level readings (Monotonicity != 1), sorted by level, with
+    prefix sums of the flow measured at the same timestamps. Answers the similar-level
+    queries of fill_flow_apply by binary search instead of a scan of all readings.
+
+    ~~~~~ INPUT  ~~~~~
+    flow_data:  not imputed flow data, with timestamp as index
+    level_data: level data with 'Monotonicity' (see calc_monotonicity), with timestamp as index
+    """
+    def __init__(self, flow_data, level_data):
+        level_data = level_data.loc[level_data['Monotonicity'] != 1, 'Value']
+        flow_values = flow_data['Value'].reindex(level_data.index).values.astype(float)
+
+        # Only levels with a measured flow contribute to the averages
+        measured = ~np.isnan(flow_values) & ~np.isnan(level_data.values)
+        order = np.argsort(level_data.values[measured], kind="mergesort")
+
+        self.levels = level_data.values[measured][order].astype(float)
+        flow_values = flow_values[measured][order]
+        self.sum = np.concatenate([[0], np.cumsum(flow_values)])
+        self.square_sum = np.concatenate([[0], np.cumsum(flow_values**2)])
+
+    def _first(self, condition, levels):
+        """
+        Position of the first indexed level for which condition(indexed_level, level) holds,
+        for each of levels. The condition has to hold from some position onwards.
+        Bisection for all levels at once.
+        """
+        lower = np.zeros(len(levels), dtype=int)
+        upper = np.full(len(levels), len(self.levels))
+
+        while np.any(lower < upper):
+            active = lower < upper
+            middle = (lower + upper) // 2
+            holds = condition(self.levels[np.minimum(middle, len(self.levels) - 1)], levels)
+            upper = np.where(active & holds, middle, upper)
+            lower = np.where(active & ~holds, middle + 1, lower)
+
+        return lower
+
+    def query(self, levels, epsilon = 0.01):
+        """
+        Mean and (population) standard deviation of the flow at all indexed levels
+        within epsilon of each of levels. NaN where there are none.
+        """
+        levels = np.asarray(levels, dtype=float)
+
+        # Window bounds by the exact rule abs(level - value) < epsilon of fill_flow_apply,
+        # as levels at exactly epsilon distance are common for rounded readings
+        with np.errstate(invalid="ignore"):
+            lower = self._first(lambda indexed, value: (indexed >= value) | (value - indexed < epsilon), levels)
+            upper = self._first(lambda indexed, value: (indexed >= value) & (indexed - value >= epsilon), levels)
+        count = np.maximum(upper - lower, 0)
+        lower = np.minimum(lower, upper)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = (self.sum[upper] - self.sum[lower]) / count
+            variance = (self.square_sum[upper] - self.square_sum[lower]) / count - mean**2
+
+        return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def fill_flow_bulk(timestamps, flow_data, level_data, on_level, epsilon = 0.01):
+    """
+    fill_flow_apply for all missing flow rows at once.
+
+    ~~~~~ INPUT  ~~~~~
+    timestamps: TimeStamps of the missing flow values
+    flow_data:  not imputed flow data, with timestamp as index
+    level_data: level data with 'Monotonicity', with timestamp as index
+    on_level:   Level where the pump turns on. Suggested 95% quantile of level value
+    epsilon:    a distance from the level corresponding to the missing flow value to be considered
+    """
+    level_rows = level_data.reindex(timestamps)
+    level_values = level_rows['Value'].values.astype(float)
+
+    # Average flow of similar level values, missing if there is too much uncertainty
+    mean, std = similar_level_index(flow_data, level_data).query(level_values, epsilon = epsilon)
+    values = np.where(std > (0.5 * mean), np.nan, mean)
+
+    # 0 if level is increasing
+    is_zero = (level_rows['Monotonicity'].values == 1) & (level_values < on_level)
+
+    return np.where(is_zero, 0.0, values)
+
+
 def fill_flow(flow_data, level_data, epsilon=0.01, beta=4, horizon=5):
     """
     Function that applies fill_flow_apply (which operates on non-imputed data frames) to the missing values.
@@ -129,13 +235,152 @@ def fill_flow(flow_data, level_data, epsilon=0.01, beta=4, horizon=5):
     on_level = np.quantile(level_data['Value'], q = 0.95)
 
     # Impute values
-    merged_flow_data_missing['Value'] = merged_flow_data_missing.apply(lambda row: fill_flow_apply(row, on_level = on_level,
-                                                                                     epsilon = epsilon,
-                                                                                     level_data = level_data,
-                                                                                     flow_data = flow_data), axis = 1)
+    merged_flow_data_missing['Value'] = fill_flow_bulk(merged_flow_data_missing['TimeStamp'], on_level = on_level,
+                                                       epsilon = epsilon,
+                                                       level_data = level_data,
+                                                       flow_data = flow_data)
     
     # Return Series of imputed values
     return pd.concat([pd.Series(merged_flow_data_missing['Value'].values,
                                 index = merged_flow_data_missing['Value'].index),
                       pd.Series(merged_flow_data.loc[non_na_indices]["Value"].values,
                                 index = merged_flow_data.loc[non_na_indices]["Value"].index)]).sort_index()
+
+
+def _map(function, n_jobs, *tasks):
+    """
+    Maps function over tasks, in a process pool with n_jobs workers unless n_jobs is 1
+    (None uses all cores).
+    """
+    if n_jobs == 1:
+        return list(map(function, *tasks))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(function, *tasks))
+
+
+def _block_monotonicity(store, start, stop, lower, upper, horizon = 5, epsilon = 3):
+    """
+    Monotonicity of the level readings start-stop, calculated on the readings lower-upper
+    which include the halo around the block.
+    """
+    level_value = np.load(os.path.join(store, "level_value.npy"), mmap_mode="r")
+    block = calc_monotonicity(pd.DataFrame({'Value': level_value[lower:upper]}), horizon = horizon, epsilon = epsilon)
+
+    return block['Monotonicity'].values[start - lower:stop - lower]
+
+
+def _impute_pump(store, level_range, flow_range, missing, epsilon = 0.01):
+    """
+    fill_flow_bulk for the missing timestamps of a single pump, from the shared arrays.
+    """
+    arrays = {name: np.load(os.path.join(store, name + ".npy"), mmap_mode="r")
+              for name in ["level_time", "level_value", "monotonicity", "flow_time", "flow_value"]}
+    level = slice(*level_range)
+    flow = slice(*flow_range)
+
+    # Without level readings there is nothing to impute from
+    if level.stop == level.start:
+        return np.full(len(missing), np.nan)
+
+    level_data = pd.DataFrame({'Value': arrays["level_value"][level],
+                               'Monotonicity': arrays["monotonicity"][level]},
+                              index = pd.DatetimeIndex(arrays["level_time"][level]))
+    flow_data = pd.DataFrame({'Value': arrays["flow_value"][flow]},
+                             index = pd.DatetimeIndex(arrays["flow_time"][flow]))
+
+    # Calculate max level boundary
+    on_level = np.quantile(level_data['Value'], q = 0.95)
+
+    return fill_flow_bulk(pd.DatetimeIndex(missing), flow_data, level_data, on_level, epsilon = epsilon)
+
+
+def fill_flow_partitioned(flow_data, level_data, epsilon=0.01, beta=4, horizon=5, by=None,
+                          block_size=500000, halo=None, n_jobs=None):
+    """
+    fill_flow for one or more pumps, partitioned over a process pool.
+
+    The monotonicity of the level readings is calculated in time blocks of block_size
+    readings, each extended by halo readings on both sides so the windows at the block
+    edges are complete. The similar-level lookups then run per pump. The level and flow
+    arrays are shared read-only with the workers through memory-mapped files.
+
+    ~~~~~ INPUT  ~~~~~
+    flow_data:  Flow data sorted by time (within each pump), e.g. from wrangling.clean_mes_data
+    level_data: Level data of the same shape
+    by:         Column of the pump, e.g. 'RG_ID' for frames of multiple pumps
+    block_size: Number of level readings per block (at least 2 * horizon + 1)
+    halo:       Number of readings added to each side of a block, at least horizon
+                to match fill_flow (default)
+    n_jobs:     Number of processes, 1 runs in the current process, None uses all cores.
+                Calls with n_jobs != 1 have to be guarded by if __name__ == "__main__".
+
+    ~~~~~ OUTPUT ~~~~~
+    Series of flow values with imputed values as fill_flow, for the rows of
+    wrangling.merge_flow_level. Indexed by TimeStamp, or by (by, TimeStamp) with by.
+    Pumps without level data keep their missing values.
+    """
+    halo = horizon if halo is None else halo
+    block_size = max(block_size, 2 * horizon + 1)
+
+    if by is None:
+        keys = [None]
+        pumps = [(flow_data, level_data)]
+    else:
+        flow_groups = dict(list(flow_data.groupby(by)))
+        level_groups = dict(list(level_data.groupby(by)))
+        keys = sorted(set(flow_groups) | set(level_groups))
+        pumps = [(flow_groups.get(i, flow_data.iloc[:0]), level_groups.get(i, level_data.iloc[:0]))
+                 for i in keys]
+
+    # Merges flow and level on timestamps, as normal flow data is biased
+    # given no measurements are made when there is no flow.
+    merged = [wrangling.merge_flow_level(flow, level)[0] for flow, level in pumps]
+
+    level_bounds = np.cumsum([0] + [len(level) for _, level in pumps])
+    flow_bounds = np.cumsum([0] + [len(flow) for flow, _ in pumps])
+
+    with tempfile.TemporaryDirectory() as store:
+        arrays = {"level_time": [level['TimeStamp'].values.astype("datetime64[ns]") for _, level in pumps],
+                  "level_value": [level['Value'].values.astype(float) for _, level in pumps],
+                  "flow_time": [flow['TimeStamp'].values.astype("datetime64[ns]") for flow, _ in pumps],
+                  "flow_value": [flow['Value'].values.astype(float) for flow, _ in pumps]}
+        for name, values in arrays.items():
+            np.save(os.path.join(store, name + ".npy"), np.concatenate(values))
+
+        # Blocks of level readings with their halo, never crossing pumps
+        blocks = [(start, min(start + block_size, upper), max(lower, start - halo),
+                   min(upper, start + block_size + halo))
+                  for lower, upper in zip(level_bounds[:-1], level_bounds[1:])
+                  for start in range(lower, upper, block_size)]
+
+        monotonicity = _map(partial(_block_monotonicity, store, horizon = horizon, epsilon = beta), n_jobs,
+                            *zip(*blocks)) if len(blocks) > 0 else []
+        np.save(os.path.join(store, "monotonicity.npy"),
+                np.concatenate(monotonicity) if len(monotonicity) > 0 else np.array([], dtype=int))
+
+        # Similar-level lookups per pump
+        missing = [data['TimeStamp'].values[data['Value'].isna().values] for data in merged]
+        imputed = _map(partial(_impute_pump, epsilon = epsilon), n_jobs,
+                       [store] * len(pumps),
+                       list(zip(level_bounds[:-1], level_bounds[1:])),
+                       list(zip(flow_bounds[:-1], flow_bounds[1:])),
+                       missing)
+
+    values = []
+    for data, filled in zip(merged, imputed):
+        value = data['Value'].values.astype(float)
+        value[np.isnan(value)] = filled
+        values.append(value)
+
+    times = [data['TimeStamp'].values for data in merged]
+    if by is None:
+        index = pd.DatetimeIndex(times[0], name = 'TimeStamp')
+    else:
+        index = pd.MultiIndex.from_arrays([np.repeat(keys, [len(i) for i in times]).astype(flow_data[by].dtype),
+                                           pd.DatetimeIndex(np.concatenate(times) if len(times) > 0 else
+                                                            np.array([], dtype="datetime64[ns]"))],
+                                          names = [by, 'TimeStamp'])
+
+    return pd.Series(np.concatenate(values) if len(values) > 0 else np.array([], dtype=float),
+                     index = index, name = 'Value')
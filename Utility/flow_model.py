@@ -18,11 +18,27 @@ import tensorflow as tf
 import keras
 
 import wrangling
+import data_imputation
 import utility
 
 import holidays
+from functools import lru_cache
 
-def add_predictor_columns(data):
+hour_columns = ["hour_" + str(i) for i in range(24)]
+month_columns = ["month_" + str(i) for i in range(1, 13)]
+predictor_columns = hour_columns + month_columns + ["is_holiday", "Constant"]
+
+
+@lru_cache(maxsize=None)
+def _holiday_dates(first_year, last_year):
+    """
+    Sorted array of all holidays in the Netherlands from first_year to last_year.
+    """
+    dates = holidays.Netherlands(years = list(range(first_year, last_year + 1)))
+    return np.array(sorted(dates), dtype="datetime64[D]")
+
+
+def add_predictor_columns(data, dtype=np.float32):
     """
     Will return predictive variables given a data-set with the 'TimeHour' column.
     'TimeHour' can be created by applying the .replace() method on the 'TimeStamp'
@@ -33,23 +49,30 @@ def add_predictor_columns(data):
     Month of the year    month_XX       Dummy, binary
     Holiday              is_holiday     Binary
 
-    Holiday is based on all holidays in the Netherlands in 2018, 2019.
+    All dummy columns are always present (see predictor_columns), so data sets of
+    different periods give the same columns. Holiday is based on all holidays in the
+    Netherlands in the years of the data.
     """
-    # Fetch holidays of given period
-    NL_holidays = [i[0] for i in holidays.Netherlands(years = [2018, 2019]).items()]
+    time = data["TimeHour"]
+    if time.dt.tz is not None:
+        time = time.dt.tz_localize(None)
+
+    X = np.zeros((len(data), len(predictor_columns)), dtype=dtype)
+    rows = np.arange(len(data))
 
-    # Create dummies for hour of day and month of year
-    hour_dummies = pd.get_dummies(data["TimeHour"].apply(lambda i: i.hour), prefix="hour")
-    month_dummies = pd.get_dummies(data["TimeHour"].apply(lambda i: i.month), prefix="month")
+    # Dummies for hour of day and month of year
+    X[rows, time.dt.hour.values] = 1
+    X[rows, len(hour_columns) + time.dt.month.values - 1] = 1
 
     # Check each date whether in holidays
-    is_holiday = data["TimeHour"].apply(lambda i: i.date() in NL_holidays).astype(int)
+    if len(data) > 0:
+        days = time.values.astype("datetime64[D]")
+        X[:, -2] = np.isin(days, _holiday_dates(int(time.dt.year.min()), int(time.dt.year.max())))
 
-    # Concatenate and add constant/intercept
-    X = pd.concat([hour_dummies, month_dummies, is_holiday], axis=1)
-    X["Constant"] = 1
+    # Add constant/intercept
+    X[:, -1] = 1
 
-    return X
+    return pd.DataFrame(X, columns=predictor_columns, index=data.index)
 
 
 class flow_model:
@@ -61,7 +84,7 @@ class flow_model:
     """
 
     def __init__(self, flow_data, level_data, rain_grid,
-                 padding=5, multiple=True, steps=12, imputation="simple"):
+                 padding=5, multiple=True, steps=12, imputation="simple", n_jobs=1):
         """
         Creates data set for model based on flow_data, level_data, rain prediction.
         """
@@ -81,7 +104,8 @@ class flow_model:
         if imputation == "simple":
             flow_data = wrangling.fill_flow(flow_data)
         elif imputation == "complex":
-            flow_data = data_imputation.fill_flow(flow_data, level_data)
+            imputed = data_imputation.fill_flow_partitioned(flow_data, level_data, n_jobs=n_jobs)
+            flow_data["Value"] = imputed.reindex(flow_data["TimeStamp"]).values
         else:
             pass
 
@@ -0,0 +1,139 @@
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ #
+# Objective: Compare flow imputation strategies on the    #
+# accuracy and cost of filling artificial gaps in a       #
+# measured pump series.                                   #
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ #
+
+import pandas as pd
+import numpy as np
+import time
+import tracemalloc
+import wrangling
+import data_imputation
+
+
+def _simple(merged_flow_data, flow_data, level_data):
+    return wrangling.fill_flow(merged_flow_data.copy())["Value"].values
+
+
+def _level(merged_flow_data, flow_data, level_data):
+    return data_imputation.fill_flow(flow_data, level_data).values
+
+
+def _level_partitioned(merged_flow_data, flow_data, level_data):
+    return data_imputation.fill_flow_partitioned(flow_data, level_data, n_jobs=1).values
+
+
+strategies = {"simple": _simple,
+              "level": _level,
+              "level_partitioned": _level_partitioned}
+
+
+def mask_gaps(candidates, single=0.01, outages=0.001, outage_length=(12, 120), seed=0):
+    """
+    Selects measurements to remove, as single missing samples and outages of several
+    consecutive samples.
+
+    ~~~~~ INPUT  ~~~~~
+    candidates:    Boolean array of the measurements that may be removed
+    single:        Share of candidates removed as single samples
+    outages:       Number of outages per candidate
+    outage_length: Minimum and maximum number of samples of an outage
+                   (12-120 is 1-10 minutes at 5 second measurements)
+    seed:          Seed of the random generator
+
+    ~~~~~ OUTPUT ~~~~~
+    Boolean array of the removed measurements (always a subset of candidates)
+    """
+    rng = np.random.default_rng(seed)
+    candidates = np.asarray(candidates, dtype=bool)
+    n = len(candidates)
+
+    mask = candidates & (rng.random(n) < single)
+
+    n_outages = rng.binomial(candidates.sum(), outages) if n > 0 else 0
+    starts = rng.integers(0, max(n, 1), n_outages)
+    lengths = rng.integers(outage_length[0], outage_length[1] + 1, n_outages)
+
+    # Mark outages by the difference of +1 at their start and -1 at their end
+    edges = np.zeros(n + 1, dtype=int)
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, np.minimum(starts + lengths, n), -1)
+    mask |= candidates & (np.cumsum(edges[:-1]) > 0)
+
+    return mask
+
+
+def benchmark_imputation(flow_data, level_data, sizes=None, methods=None, single=0.01, outages=0.001,
+                         outage_length=(12, 120), seed=0):
+    """
+    Removes known flow measurements and compares how well and how fast each imputation
+    strategy fills them in, for increasing lengths of the series.
+
+    Only measurements with a level reading at the same time are removed, so the
+    level-based imputation sees the same rows as the simple fill.
+
+    ~~~~~ INPUT  ~~~~~
+    flow_data:     Flow data of a single pump, e.g. from wrangling.clean_mes_data
+    level_data:    Level data of the same pump
+    sizes:         Numbers of level readings (from the start) to benchmark on,
+                   the complete series by default
+    methods:       Names in strategies, all by default
+    single, outages, outage_length, seed: See mask_gaps
+
+    ~~~ EXAMPLE CALL ~~~
+    benchmark_imputation(flow_data, level_data, sizes=[17280, 120960, 518400], methods=["simple", "level"])
+
+    ~~~~~ OUTPUT ~~~~~
+    A data frame with one row per strategy and size with the columns
+    Strategy: Name of the imputation strategy
+    Rows:     Number of rows of the merged flow and level data
+    Masked:   Number of removed measurements
+    RMSE:     Root mean squared error on the removed measurements that were imputed
+    NaN:      Share of removed measurements left missing
+    Seconds:  Wall time of the imputation
+    PeakMB:   Peak memory allocated during the imputation
+    """
+    if sizes is None:
+        sizes = [len(level_data)]
+    if methods is None:
+        methods = list(strategies)
+
+    results = []
+    for size in sizes:
+        # Data up to the size-th level reading
+        end = level_data["TimeStamp"].iloc[min(size, len(level_data)) - 1]
+        flow = flow_data.loc[flow_data["TimeStamp"] <= end].reset_index(drop=True)
+        level = level_data.loc[level_data["TimeStamp"] <= end].reset_index(drop=True)
+
+        merged_flow_data, _ = wrangling.merge_flow_level(flow, level)
+        truth = merged_flow_data["Value"].values.astype(float)
+
+        candidates = ~np.isnan(truth) & merged_flow_data["TimeStamp"].isin(level["TimeStamp"]).values
+        mask = mask_gaps(candidates, single=single, outages=outages, outage_length=outage_length, seed=seed)
+
+        masked_merged = merged_flow_data.copy()
+        masked_merged.loc[mask, "Value"] = np.nan
+        masked_flow = flow.loc[~flow["TimeStamp"].isin(merged_flow_data["TimeStamp"][mask])].reset_index(drop=True)
+
+        for method in methods:
+            tracemalloc.start()
+            start = time.perf_counter()
+            imputed = strategies[method](masked_merged, masked_flow, level)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            imputed = np.asarray(imputed, dtype=float)[mask]
+            errors = imputed - truth[mask]
+            filled = ~np.isnan(errors)
+
+            results.append({"Strategy": method,
+                            "Rows": len(merged_flow_data),
+                            "Masked": int(mask.sum()),
+                            "RMSE": np.sqrt(np.mean(errors[filled]**2)) if filled.any() else np.nan,
+                            "NaN": 1 - filled.mean() if len(filled) > 0 else np.nan,
+                            "Seconds": seconds,
+                            "PeakMB": peak / 2**20})
+
+    return pd.DataFrame(results)
@@ -9,7 +9,14 @@ import datetime
 import geopandas as gpd
 import os
 import pickle
-import utility
+import sqlite3
+import hashlib
+import json
+import shutil
+import io
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 
 
 # Codes of pumps
@@ -22,23 +29,314 @@ pump_to_id_dict = {"Drunen": 8150,
                    "Maaspoort": 501}
 
 
-def get_measurements(path, convert_time=True):
+# Format of timestamps in the old type measurement files
+TIME_FORMAT = "%d-%m-%Y %H:%M:%S"
+
+# Column types of the different csv formats, used when reading the files
+old_type_dtypes = {"Tagname": str, "TimeStamp": str, "Value": float, "DataQuality": str}
+historian_dtypes = {"historianTagnummer": str, "datumBeginMeting": str,
+                    "hstWaarde": float, "historianKwaliteit": float}
+pump_level_columns = {"002: Oude Engelenseweg Niveau actueel (1&2)(cm)": "Oude Engelenseweg",
+                      "003: Helftheuvelweg Niveau (cm)": "Helftheuvelweg",
+                      "004: Engelerschans Niveau trend niveau DWA(cm)": "Engelerschans",
+                      "005: De Rompert Niveau (cm)": "De Rompert",
+                      "006: Maaspoort Niveau actueel (1&2)(cm)": "Maaspoort"}
+pump_level_dtypes = dict({"Datum": str, "Tijd": str}, **{i: float for i in pump_level_columns})
+
+# Arguments of pd.read_csv for the different csv formats
+csv_options = {"old_type": dict(sep=";", decimal=",", usecols=list(old_type_dtypes), dtype=old_type_dtypes),
+               "historian": dict(sep=",", usecols=list(historian_dtypes), dtype=historian_dtypes),
+               "pump_level": dict(sep=";", decimal=",", usecols=list(pump_level_dtypes), dtype=pump_level_dtypes),
+               "rain": dict(skiprows=2)}
+
+
+def _detect_format(path):
     """
-    Will read all measurement data from given path and store them in separate dataframes.
+    Returns the format of the measurement files in path as understood by load_all_pumps.
+    """
+    # OLD TYPE FLOW AND LEVEL VALUES FOR HAARSTEEG AND DRUNEN
+    if ("RG8150" in path) or ("RG8170" in path):
+        return "old_type"
+    # NEW TYPE FLOW AND LEVEL VALUES FOR HAARSTEEG AND BOKHOVEN
+    if ("RG8180_L0" in path) or ("RG8180_Q0" in path) or ("rg8170_N99" in path) or ("rg8170_99" in path):
+        return "historian"
+    # LEVEL VALUES OF SMALL PUMPS
+    if "data_pump_level" in path:
+        return "pump_level"
+    # NEW TYPE FLOW OF WWTP AND SMALL PUMPS
+    if ("data_pump_flow" in path) or ("data_wwtp_flow" in path):
+        return "historian_flow"
+
+
+def _in_range(time, from_date=None, to_date=None):
+    """
+    Returns a boolean array whether time lies within [from_date, to_date).
+    """
+    selection = np.repeat(True, len(time))
+    if from_date is not None:
+        selection &= np.asarray(time >= pd.to_datetime(from_date))
+    if to_date is not None:
+        selection &= np.asarray(time < pd.to_datetime(to_date))
+    return selection
+
+
+def _raw_time(data, csv_format):
+    """
+    Parses the time of raw data of the given csv format.
+    """
+    if csv_format == "old_type":
+        return pd.to_datetime(data["TimeStamp"], format=TIME_FORMAT)
+    if csv_format == "historian":
+        return pd.to_datetime(data["datumBeginMeting"])
+    if csv_format == "pump_level":
+        return pd.to_datetime(data["Datum"] + " " + data["Tijd"], format=TIME_FORMAT)
+    if csv_format == "rain":
+        return pd.to_datetime(data["Begin"], format=TIME_FORMAT)
+
+
+def _select_time(data, csv_format, from_date=None, to_date=None):
+    """
+    Drops rows of raw data outside of [from_date, to_date).
+    Returns the remaining data and its parsed time.
+    """
+    time = _raw_time(data, csv_format)
+    selection = _in_range(time, from_date, to_date)
+    if not selection.all():
+        data, time = data.loc[selection].copy(), time[selection]
+    return data, time
+
+
+def _file_time_range(file, csv_format):
+    """
+    Returns the time of the first and last row of a file without reading the rest of
+    it, None if the rows cannot be parsed.
+    """
+    options = dict(csv_options[csv_format])
+    skiprows = options.pop("skiprows", 0)
+    
+    try:
+        with open(file, "rb") as f:
+            lines = [f.readline() for i in range(skiprows + 2)]
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 4096, 0))
+            last = [i for i in f.read().splitlines() if i.strip()][-1]
+        
+        header, first = lines[skiprows], lines[skiprows + 1].rstrip(b"\r\n")
+        time = _raw_time(pd.read_csv(io.BytesIO(header + first + b"\n" + last + b"\n"), **options), csv_format)
+    except Exception:
+        return None
+    
+    return time.min(), time.max()
+
+
+def _file_in_range(file, csv_format, from_date=None, to_date=None):
+    """
+    Checks on the first and last row of a file whether it holds data within
+    [from_date, to_date). Files are assumed to be ordered by time. If the rows
+    cannot be parsed, the file is kept.
+    """
+    if (from_date is None) and (to_date is None):
+        return True
+    
+    time_range = _file_time_range(file, csv_format)
+    if time_range is None:
+        return True
+    
+    return ((from_date is None) or (time_range[1] >= pd.to_datetime(from_date))) and \
+           ((to_date is None) or (time_range[0] < pd.to_datetime(to_date)))
+
+
+def _select_pumps(data, RG_ID=None):
+    """
+    Selects the rows of standardized data belonging to a pump or list of pumps.
+    """
+    if RG_ID is None:
+        return data
+    
+    RG_ID = [RG_ID] if np.isscalar(RG_ID) else list(RG_ID)
+    return data.loc[data["RG_ID"].isin(RG_ID)].reset_index(drop=True)
+
+
+def _old_type_ids(data):
+    """
+    RG_ID of every row of parsed old type data.
+    """
+    return data["Tagname"].str.slice(9,13).astype(int)
+
+
+def _historian_ids(data, path):
+    """
+    RG_ID of every row of parsed historian data from path.
+    """
+    if "data_pump_flow" in path:
+        return data["historianTagnummer"].str.slice(26,29).astype(int)
+    elif "data_wwtp_flow" in path:
+        if "1882" in path:
+            return pd.Series(1882, index=data.index)
+        elif "1876" in path:
+            return pd.Series(1876, index=data.index)
+        else:
+            return pd.Series(0, index=data.index)
+    else:
+        return data["historianTagnummer"].str.slice(9,13).astype(int)
+
+
+def _select_raw_pumps(data, csv_format, RG_ID=None, path=None):
+    """
+    Selects the pumps of parsed data of a single file before it is concatenated and
+    standardized. Level data of the small pumps keeps only the columns of the pumps.
+    """
+    if RG_ID is None:
+        return data
+    
+    RG_ID = [RG_ID] if np.isscalar(RG_ID) else list(RG_ID)
+    if csv_format == "pump_level":
+        return data.drop(columns=[i for i, j in pump_to_id_dict.items() if (j not in RG_ID) and (i in data.columns)])
+    
+    ids = _old_type_ids(data) if csv_format == "old_type" else _historian_ids(data, path)
+    return data.loc[ids.isin(RG_ID).values]
+
+
+def _output(data, RG_ID=None, compact=False):
+    """
+    Selects pumps of standardized data and applies the compact schema if asked for.
+    The pumps are already selected per file, this selection is a safety net.
+    """
+    data = _select_pumps(data, RG_ID)
+    return compact_schema(data) if compact else data
+
+
+def compact_schema(data):
+    """
+    Returns a copy of standardized measurement data or rain data in a compact schema:
+    
+    NAME ~~~~~~~~~~~~~~~ FORMAT
+    RG_ID                int16
+    TimeStamp            datetime64 (also Start and End of rain data)
+    Value                float32 (also the area columns of rain data)
+    DataQuality          bool
+    
+    Other columns are kept as they are. See memory_report for the savings.
+    """
+    data = data.copy()
+    
+    for i in data.columns:
+        if i == "RG_ID":
+            data[i] = data[i].astype(np.int16)
+        elif i == "DataQuality":
+            data[i] = data[i].astype(bool)
+        elif i in ["TimeStamp", "Start", "End"]:
+            if not pd.api.types.is_datetime64_any_dtype(data[i]):
+                try:
+                    data[i] = pd.to_datetime(data[i], format=TIME_FORMAT)
+                except ValueError:
+                    data[i] = pd.to_datetime(data[i])
+        elif pd.api.types.is_float_dtype(data[i]):
+            data[i] = data[i].astype(np.float32)
+    
+    return data
+
+
+def memory_report(data):
+    """
+    Compares the memory usage (in MB) of every column of data with its compact schema.
     ~~~ EXAMPLE CALL ~~~
-    flow_data, level_data = get_measurements("C:/mypath/RG8150")
+    memory_report(load_all_pumps(path+"Data 1/sewer_data/data_pump/RG8180_L0"))
     ~~~~~~~~~~~~~~~~~~~~
     """
-    files = os.listdir(path)
+    compact_data = compact_schema(data)
     
-    data = [pd.read_csv(path + "/" + i, sep = ";") for i in files]
-    data =  pd.concat(data, sort = False, ignore_index = True)
+    report = pd.DataFrame({"dtype": data.dtypes.astype(str),
+                           "MB": data.memory_usage(index=False, deep=True) / 2**20,
+                           "compact_dtype": compact_data.dtypes.astype(str),
+                           "compact_MB": compact_data.memory_usage(index=False, deep=True) / 2**20})
+    report.loc["Total"] = ["", report["MB"].sum(), "", report["compact_MB"].sum()]
+    report["saving"] = 1 - report["compact_MB"] / report["MB"]
     
-    data["RG_ID"] = data["Tagname"].str.slice(9,13).astype(int)
-    data["Value"] = data["Value"].str.replace(",", ".").astype(float)
-    data["DataQuality"] = (data["DataQuality"] == "Good").astype(int)
+    return report
+
+
+def _parse_old_type(data, convert_time=True, from_date=None, to_date=None):
+    """
+    Selects the time range of raw old type measurement data and converts its time.
+    """
+    if (convert_time == True) or (from_date is not None) or (to_date is not None):
+        data, time = _select_time(data, "old_type", from_date, to_date)
+        if convert_time == True:
+            data["TimeStamp"] = time
+    return data
+
+
+def _parse_historian(data, convert_time=True, from_date=None, to_date=None):
+    """
+    Selects the time range of raw historian data. If convert_time is True,
+    'datumBeginMeting' is rewritten to the same string format as the old type files.
+    """
+    if (convert_time == True) or (from_date is not None) or (to_date is not None):
+        data, time = _select_time(data, "historian", from_date, to_date)
+        if convert_time == True:
+            data["datumBeginMeting"] = time.dt.strftime(TIME_FORMAT)
+    return data
+
+
+def _parse_pump_level(data, convert_time=True, from_date=None, to_date=None):
+    """
+    Selects the time range of raw level data of the small pumps, renames its columns
+    and creates 'TimeStamp'.
+    """
+    if (convert_time == True) or (from_date is not None) or (to_date is not None):
+        data, time = _select_time(data, "pump_level", from_date, to_date)
+    data.rename(columns=pump_level_columns, inplace=True)
+
+    data["TimeStamp"] = data["Datum"] + " " + data["Tijd"]
     if convert_time == True:
-        data["TimeStamp"] = pd.to_datetime(data["TimeStamp"], format="%d-%m-%Y %H:%M:%S")
+        data["TimeStamp"] = time
+    return data
+
+
+parsers = {"old_type": _parse_old_type,
+           "historian": _parse_historian,
+           "pump_level": _parse_pump_level}
+
+
+def _read_file(file, csv_format, convert_time=True, from_date=None, to_date=None, RG_ID=None, path=None):
+    """
+    Reads and parses a single measurement file of the given csv format, keeping only
+    the pumps RG_ID (path is the folder, see _historian_ids).
+    """
+    # Files outside of the time range are only read for their columns
+    nrows = None if _file_in_range(file, csv_format, from_date, to_date) else 0
+    
+    data = pd.read_csv(file, nrows=nrows, **csv_options[csv_format])
+    data = parsers[csv_format](data, convert_time=convert_time, from_date=from_date, to_date=to_date)
+    return _select_raw_pumps(data, csv_format, RG_ID, file if path is None else path)
+
+
+def _read_files(files, csv_format, convert_time=True, n_jobs=1, from_date=None, to_date=None, RG_ID=None,
+                path=None):
+    """
+    Reads all files and concatenates the results in the order of files.
+    If n_jobs is not 1, the files are read in a process pool with n_jobs workers
+    (None uses all cores).
+    """
+    reader = partial(_read_file, csv_format=csv_format, convert_time=convert_time,
+                     from_date=from_date, to_date=to_date, RG_ID=RG_ID, path=path)
+
+    if n_jobs == 1:
+        data = [reader(i) for i in files]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            data = list(executor.map(reader, files))
+
+    return pd.concat(data, sort = False, ignore_index = True)
+
+
+def _standardize_old_type(data):
+    """
+    Splits parsed old type data into flow and level data of the standardized format.
+    """
+    data["RG_ID"] = _old_type_ids(data)
+    data["DataQuality"] = (data["DataQuality"] == "Good").astype(int)
         
     data = data[["Tagname", "RG_ID", "TimeStamp", "Value", "DataQuality"]]
     
@@ -51,98 +349,223 @@ def get_measurements(path, convert_time=True):
     return flow_data, level_data
 
 
-def load_all_pumps(path, convert_time=True):
+def _standardize_historian(data, path):
+    """
+    Brings parsed historian data from path into the standardized format.
+    """
+    data["RG_ID"] = _historian_ids(data, path)
+        
+    data["Value"] = data["hstWaarde"]
+    data["DataQuality"] = (data["historianKwaliteit"] == 100).astype(int)
+    
+    data.rename(columns={"datumBeginMeting": "TimeStamp"}, inplace=True)
+    
+    return data[["RG_ID", "TimeStamp", "Value", "DataQuality"]]
+
+
+def _standardize_pump_level(data):
+    """
+    Stacks the pump columns of parsed level data of the small pumps into the
+    standardized format. Pump columns dropped by _select_raw_pumps are left out.
+    """
+    pumps = [i for i in ["Oude Engelenseweg", "Helftheuvelweg", "Engelerschans", "De Rompert", "Maaspoort"]
+             if i in data.columns]
+    if len(pumps) == 0:
+        return pd.DataFrame({"TimeStamp": data["TimeStamp"].iloc[:0], "Value": [], "RG_ID": []})
+    
+    data_len = len(data)
+    data = pd.concat([data[["TimeStamp", i]].rename(columns={i: "Value"}) for i in pumps],
+                      axis=0, ignore_index=True)
+
+    data["RG_ID"] = list(map(lambda i: pump_to_id_dict[i], np.repeat(pumps, data_len)))
+    
+    return data
+
+
+def get_measurements(path, convert_time=True, n_jobs=1, from_date=None, to_date=None, RG_ID=None,
+                     compact=False):
+    """
+    Will read all measurement data from given path and store them in separate dataframes.
+    ~~~ EXAMPLE CALL ~~~
+    flow_data, level_data = get_measurements("C:/mypath/RG8150")
+    ~~~~~~~~~~~~~~~~~~~~
+
+    n_jobs             :    Number of processes used to read the files. 1 reads them one
+                            after another, None uses all cores. On Windows, calls with
+                            n_jobs != 1 have to be guarded by if __name__ == "__main__".
+    from_date, to_date :    Only keep measurements within [from_date, to_date). Files whose
+                            first and last rows lie outside of the range are skipped.
+    RG_ID              :    Only keep measurements of a pump or list of pumps.
+    compact            :    Return the compact schema, see compact_schema.
+    """
+    files = [path + "/" + i for i in sorted(os.listdir(path))]
+
+    data = _read_files(files, "old_type", convert_time=convert_time, n_jobs=n_jobs,
+                       from_date=from_date, to_date=to_date, RG_ID=RG_ID)
+    flow_data, level_data = _standardize_old_type(data)
+    
+    return _output(flow_data, RG_ID, compact), _output(level_data, RG_ID, compact)
+
+
+def load_all_pumps(path, convert_time=True, n_jobs=1, from_date=None, to_date=None, RG_ID=None,
+                   compact=False):
     """
     Will read all measurement data from given path and store them in separate dataframes.
     The format of all data sources is standardized.
     ~~~ EXAMPLE CALL ~~~
     level_bokhoven = load_all_pumps(path+"Data 1/sewer_data/data_pump/RG8180_L0")
     ~~~~~~~~~~~~~~~~~~~~
+
+    n_jobs, from_date, to_date, RG_ID, compact :    See get_measurements.
     """
-    files = os.listdir(path)
+    files = [path + "/" + i for i in sorted(os.listdir(path)) if ".csv" in i]
+    csv_format = _detect_format(path)
+    selection = dict(from_date=from_date, to_date=to_date, RG_ID=RG_ID, path=path)
     
-    # OLD TYPE FLOW AND LEVEL VALUES FOR HAARSTEEG AND DRUNEN
-    if ("RG8150" in path) or ("RG8170" in path):
-        return get_measurements(path, convert_time=convert_time)
-        
+    if csv_format == "old_type":
+        return get_measurements(path, convert_time=convert_time, n_jobs=n_jobs, RG_ID=RG_ID,
+                                compact=compact, from_date=from_date, to_date=to_date)
     
-    # NEW TYPE FLOW AND LEVEL VALUES FOR HAARSTEEG AND BOKHOVEN
-    if ("RG8180_L0" in path) or ("RG8180_Q0" in path) or ("rg8170_N99" in path) or ("rg8170_99" in path):
-        data = [pd.read_csv(path + "/" + i, sep = ",") for i in files if ".csv" in i]
-        data =  pd.concat(data, sort = False, ignore_index = True)
-        
-        data["RG_ID"] = data["historianTagnummer"].str.slice(9,13).astype(int)
-        data["Value"] = data["hstWaarde"]
-        
-        data["DataQuality"] = (data["historianKwaliteit"] == 100).astype(int)
-        
-        if convert_time == True:
-            data["datumBeginMeting"] = pd.to_datetime(data["datumBeginMeting"]).dt.strftime("%d-%m-%Y %H:%M:%S")
-        
-        data.rename(columns={"datumBeginMeting": "TimeStamp"}, inplace=True)
-        
-        return data[["RG_ID", "TimeStamp", "Value", "DataQuality"]]
+    if csv_format == "historian":
+        data = _read_files(files, "historian", convert_time=convert_time, n_jobs=n_jobs, **selection)
+        return _output(_standardize_historian(data, path), RG_ID, compact)
     
+    if csv_format == "pump_level":
+        data = _read_files(files, "pump_level", convert_time=convert_time, n_jobs=n_jobs, **selection)
+        return _output(_standardize_pump_level(data), RG_ID, compact)
     
-    # LEVEL VALUES OF SMALL PUMPS
-    if "data_pump_level" in path:
-        data = [pd.read_csv(path + "/" + i, sep = ";") for i in files if ".csv" in i]
-        data =  pd.concat(data, sort = False, ignore_index = True)
-        
-        data.rename(columns={"002: Oude Engelenseweg Niveau actueel (1&2)(cm)": "Oude Engelenseweg",
-                             "003: Helftheuvelweg Niveau (cm)": "Helftheuvelweg",
-                             "004: Engelerschans Niveau trend niveau DWA(cm)": "Engelerschans",
-                             "005: De Rompert Niveau (cm)": "De Rompert",
-                             "006: Maaspoort Niveau actueel (1&2)(cm)": "Maaspoort"}, inplace=True)
+    # Flow of WWTP and small pumps always has its time converted
+    if csv_format == "historian_flow":
+        data = _read_files(files, "historian", convert_time=True, n_jobs=n_jobs, **selection)
+        return _output(_standardize_historian(data, path), RG_ID, compact)
 
-        data['TimeStamp'] = data['Datum'] + " " + data['Tijd']
-        
-        if convert_time == True:
-            data["TimeStamp"] = pd.to_datetime(data["TimeStamp"], format="%d-%m-%Y %H:%M:%S")
 
-        for i in ["Oude Engelenseweg", "Helftheuvelweg", "Engelerschans", "De Rompert", "Maaspoort"]:
-            data.loc[:, i] = data.loc[:, i].str.replace(",", ".").astype(float)
+def stream_all_pumps(path, convert_time=True, chunksize=None, from_date=None, to_date=None, RG_ID=None,
+                     compact=False):
+    """
+    Generator version of load_all_pumps. Reads the files in path one after another and
+    yields the standardized data chunk by chunk, so that only a single chunk is held
+    in memory at a time.
+    ~~~ EXAMPLE CALL ~~~
+    for chunk in stream_all_pumps(path+"Data 1/sewer_data/data_pump/RG8180_L0", chunksize=10**6):
+        ...
+    ~~~~~~~~~~~~~~~~~~~~
+    
+    chunksize                  :    Maximum number of csv rows per chunk. If None, every
+                                    file is a chunk.
+    from_date, to_date, RG_ID, compact  :    See get_measurements.
+    
+    Old type folders (RG8150, RG8170) yield tuples (flow_chunk, level_chunk) like
+    get_measurements. Level chunks of the small pumps are stacked per chunk rather
+    than over the whole folder, thus rows come in a different order than in
+    load_all_pumps.
+    """
+    csv_format = _detect_format(path)
+    if csv_format == "old_type":
+        files = [path + "/" + i for i in sorted(os.listdir(path))]
+    else:
+        files = [path + "/" + i for i in sorted(os.listdir(path)) if ".csv" in i]
+    
+    # Flow of WWTP and small pumps always has its time converted
+    if csv_format == "historian_flow":
+        csv_format, convert_time = "historian", True
+    
+    for file in files:
+        if not _file_in_range(file, csv_format, from_date, to_date):
+            continue
         
-        data_len = len(data)
-        data = pd.concat([data[["TimeStamp", "Oude Engelenseweg"]].rename(columns={"Oude Engelenseweg": "Value"}),
-                           data[["TimeStamp", "Helftheuvelweg"]].rename(columns={"Helftheuvelweg": "Value"}),
-                           data[["TimeStamp", "Engelerschans"]].rename(columns={"Engelerschans": "Value"}),
-                           data[["TimeStamp", "De Rompert"]].rename(columns={"De Rompert": "Value"}),
-                           data[["TimeStamp", "Maaspoort"]].rename(columns={"Maaspoort": "Value"})],
-                          axis=0, ignore_index=True)
-
-        data["RG_ID"] = list(map(lambda i: pump_to_id_dict[i],
-                                 np.repeat(["Oude Engelenseweg", "Helftheuvelweg",
-                                            "Engelerschans", "De Rompert", "Maaspoort"], data_len)))
+        chunks = pd.read_csv(file, chunksize=chunksize, **csv_options[csv_format])
+        if chunksize is None:
+            chunks = [chunks]
         
-        return data
-    
+        for chunk in chunks:
+            chunk = parsers[csv_format](chunk, convert_time=convert_time, from_date=from_date, to_date=to_date)
+            chunk = _select_raw_pumps(chunk, csv_format, RG_ID, path)
+            
+            if csv_format == "old_type":
+                flow_chunk, level_chunk = _standardize_old_type(chunk)
+                yield _output(flow_chunk, RG_ID, compact), _output(level_chunk, RG_ID, compact)
+            elif csv_format == "historian":
+                yield _output(_standardize_historian(chunk, path), RG_ID, compact)
+            else:
+                yield _output(_standardize_pump_level(chunk), RG_ID, compact)
 
-    # NEW TYPE FLOW OF WWTP AND SMALL PUMPS
-    if ("data_pump_flow" in path) or ("data_wwtp_flow" in path):
-        data = [pd.read_csv(path + "/" + i, sep = ",") for i in files if ".csv" in i]
-        data =  pd.concat(data, sort = False, ignore_index = True)
 
-        if "data_pump_flow" in path:
-            data["RG_ID"] = data["historianTagnummer"].str.slice(26,29).astype(int)
-        else:
-            if "1882" in path:
-                data["RG_ID"] = 1882
-            elif "1876" in path:
-                data["RG_ID"] = 1876
-            else:
-                data["RG_ID"] = 0
-            
-        data["Value"] = data["hstWaarde"]
-        data["DataQuality"] = (data["historianKwaliteit"] == 100).astype(int)
+# Rows and columns of the full KNMI prediction grid (ncols and nrows of its header)
+full_grid_shape = (300, 300)
 
-        data["TimeStamp"] = pd.to_datetime(data["datumBeginMeting"]).dt.strftime('%d-%m-%Y %H:%M:%S')
-        data = data[["RG_ID", "TimeStamp", "Value", "DataQuality"]]
-        
-        return data
+# Rows and columns of the prediction grid covering the relevant area
+# Y: 51.830-51.321 X: 5.068-6.048
+reduced_window = (slice(91, 195+1), slice(101, 223+1))
+
+
+def _parse_grid_header(f, header_lines=7):
+    """
+    Parses the header lines of an opened ASCII grid file.
+    """
+    header = [next(f).split() for i in range(header_lines)]
+    return {i[0].lower(): float(i[1]) for i in header}
+
+
+def read_grid_header(file, header_lines=7):
+    """
+    Reads the header of an ASCII grid file (e.g. 'ncols 300') into a dictionary
+    with lower case keys and numeric values.
+    """
+    with open(file) as f:
+        return _parse_grid_header(f, header_lines)
+
+
+def read_ascii_grid(file, window=None, nodata=np.nan, header_lines=7):
+    """
+    Reads an ASCII grid file (as the harmonie rain predictions) into a float32 array.
+    ~~~ EXAMPLE CALL ~~~
+    grid = read_ascii_grid("C:/mypath/knmi..../harm....asc", window=reduced_window)
+    ~~~~~~~~~~~~~~~~~~~~
+
+    window :    Tuple of row and column slices. Only the rows within the window are parsed.
+    nodata :    Value replacing the header's NODATA_value. If None, values are kept as is.
+    """
+    with open(file) as f:
+        header = _parse_grid_header(f, header_lines)
+
+        nrows, ncols = int(header["nrows"]), int(header["ncols"])
+        rows, cols = window if window is not None else (slice(None), slice(None))
+        first, last, _ = rows.indices(nrows)
+
+        # Skip rows above the window, stop reading after the last row of the window
+        lines = islice(f, first, last)
+        data = np.fromstring("".join(lines), sep=" ", dtype=np.float32).reshape(-1, ncols)[::rows.step, cols]
+
+    if (nodata is not None) and ("nodata_value" in header):
+        data[data == header["nodata_value"]] = nodata
+
+    return data
+
+
+def _prediction_files(path, from_date=None, to_date=None):
+    """
+    Returns the grid files in path (sorted by name) and a data frame of the dates
+    in their names. Files are selected by start date if from_date and to_date are given.
+    """
+    files = pd.Series(sorted(i for i in os.listdir(path) if ".aux" not in i), dtype=object)
+    
+    dates = pd.Series(pd.to_datetime([i.split("_")[3] for i in files]))
+    
+    if (from_date is not None) or (to_date is not None):
+        files = files[_in_range(dates, from_date, to_date)].reset_index(drop=True)
+    
+    pred_date = pd.Series(pd.to_datetime([i.split("_")[2] for i in files]))
+    start_date = pd.Series(pd.to_datetime([i.split("_")[3] for i in files]))
+    end_date = pd.Series(pd.to_datetime([i.split("_")[4][:20] for i in files]))
+    
+    date_data = pd.concat([pred_date, start_date, end_date], axis=1)
+    date_data.columns = ["pred", "start", "end"]
+    
+    return files.to_list(), date_data
 
 
-def get_rain_prediction(path, from_date=None, to_date=None, reduce_grid=False):
+def get_rain_prediction(path, from_date=None, to_date=None, reduce_grid=False, nodata=None):
     """
     Will read rain prediction data + dates from file names from given path and store those
     in separate dataframes.
@@ -152,46 +575,122 @@ def get_rain_prediction(path, from_date=None, to_date=None, reduce_grid=False):
     
     reduce_grid :    Skims down the data to the relevant area. Highly recommended if
                      your PC runs <16GB RAM.
+    nodata      :    Value replacing missing grid cells, see read_ascii_grid.
+    """
+    files, date_data = _prediction_files(path, from_date, to_date)
+    
+    window = reduced_window if reduce_grid else None
+    data = np.array([read_ascii_grid(path + "/" + i, window=window, nodata=nodata) for i in files])
+    
+    return date_data, data
+
+
+def convert_rain_prediction(path, store_path, reduce_grid=False, nodata=None):
     """
-    files = os.listdir(path)
+    Converts the rain prediction grids in path once into a binary store that can be
+    opened with load_rain_prediction without reading all grids into memory.
+    ~~~ EXAMPLE CALL ~~~
+    convert_rain_prediction("C:/mypath/knmi....", "C:/mypath/rain_prediction_store")
+    ~~~~~~~~~~~~~~~~~~~~
     
-    dates = pd.Series(pd.to_datetime([i.split("_")[3] for i in files if ".aux" not in i]))
+    The store consists of 'pred_data.npy' holding all grids ordered by start date and
+    'pred_dates.csv' holding the pred/start/end dates of every grid. Grids are written
+    one by one, so memory use is that of a single grid.
+    """
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
     
-    if (from_date is not None) & (to_date is not None):
-        boolean_ = (dates >= pd.to_datetime(from_date)) & (dates < pd.to_datetime(to_date))
-        files = pd.Series(files)[boolean_]
+    files, date_data = _prediction_files(path)
     
-    pred_date = pd.Series(pd.to_datetime([i.split("_")[2] for i in files if ".aux" not in i]))
-    start_date = pd.Series(pd.to_datetime([i.split("_")[3] for i in files if ".aux" not in i]))
-    end_date = pd.Series(pd.to_datetime([i.split("_")[4][:20] for i in files if ".aux" not in i]))
+    # Order by start date so that time ranges are contiguous slices of the store
+    order = date_data.sort_values(["start", "pred"], kind="mergesort").index
+    date_data = date_data.loc[order].reset_index(drop=True)
+    files = [files[i] for i in order]
     
-    if reduce_grid:                                            #Y: 51.830-51.321 X: 5.068-6.048
-        data = np.array([np.loadtxt(path + "/" + i, skiprows=7)[91:(195+1), 101:(223+1)]
-                         for i in files if ".aux" not in i])
-    else:
-        data = np.array([np.loadtxt(path + "/" + i, skiprows=7) for i in files if ".aux" not in i])
+    window = reduced_window if reduce_grid else None
+    first = read_ascii_grid(path + "/" + files[0], window=window, nodata=nodata)
     
-    date_data = pd.concat([pred_date, start_date, end_date], axis=1)
-    date_data.columns = ["pred", "start", "end"]
+    data = np.lib.format.open_memmap(store_path + "/" + "pred_data.npy", mode="w+", dtype=first.dtype,
+                                     shape=(len(files),) + first.shape)
+    
+    data[0] = first
+    for i, j in enumerate(files[1:], start=1):
+        data[i] = read_ascii_grid(path + "/" + j, window=window, nodata=nodata)
+    
+    data.flush()
+    del data
+    
+    date_data.to_csv(store_path + "/" + "pred_dates.csv", index=False)
+
+
+def load_rain_prediction(store_path, from_date=None, to_date=None, reduce_grid=False):
+    """
+    Opens a store written by convert_rain_prediction. Returns the same tuple as
+    get_rain_prediction, but the grids are a read-only memory map, so only the
+    parts that are actually used are read from disk.
+    ~~~ EXAMPLE CALL ~~~
+    pred_dates, pred_data = load_rain_prediction("C:/mypath/rain_prediction_store",
+                                                 from_date="2019-01-01", to_date="2019-02-01")
+    ~~~~~~~~~~~~~~~~~~~~
+    
+    from_date, to_date :    Select grids by start date (to_date is exclusive).
+    reduce_grid        :    Returns the relevant area only. Has no effect if the store
+                            was already converted with reduce_grid=True, which is detected
+                            by grids smaller than full_grid_shape.
+    
+    Slicing by time and area gives views of the memory map, no data is copied.
+    Use np.array(pred_data) to load the selection into memory.
+    """
+    date_data = pd.read_csv(store_path + "/" + "pred_dates.csv", parse_dates=["pred", "start", "end"])
+    data = np.load(store_path + "/" + "pred_data.npy", mmap_mode="r")
+    
+    # Start dates are sorted, hence a time range is a contiguous slice
+    start, end = 0, len(date_data)
+    if from_date is not None:
+        start = date_data["start"].searchsorted(pd.to_datetime(from_date), side="left")
+    if to_date is not None:
+        end = date_data["start"].searchsorted(pd.to_datetime(to_date), side="left")
+    
+    date_data = date_data.iloc[start:end].reset_index(drop=True)
+    data = data[start:end]
+    
+    # Grids of a store converted with reduce_grid=True are already reduced
+    if reduce_grid and data.shape[1:] == full_grid_shape:
+        data = data[(slice(None),) + reduced_window]
     
     return date_data, data
 
 
-def get_rain(path, convert_time=True):
+def get_rain(path, convert_time=True, from_date=None, to_date=None, compact=False):
     """
     Will read all rain data from given path and store them in a single dataframe.
     ~~~ EXAMPLE CALL ~~~
     rain_data = get_rain("C:/mypath/rain_timeseries")
     ~~~~~~~~~~~~~~~~~~~~
+    
+    from_date, to_date :    Only keep rows starting within [from_date, to_date). Files whose
+                            first and last rows lie outside of the range are skipped.
+    compact            :    Return the compact schema, see compact_schema.
     """
     
-    files = os.listdir(path)
+    files = [path + "/" + i for i in os.listdir(path)]
     
-    data = [pd.read_csv(path + "/" + i, skiprows=2) for i in files]
+    data = _read_rain_files(files, convert_time=convert_time, from_date=from_date, to_date=to_date)
+    return compact_schema(data) if compact else data
+
+
+def _read_rain_files(files, convert_time=True, from_date=None, to_date=None):
+    """
+    Reads the given rain files into a single dataframe, see get_rain.
+    """
+    data = [pd.read_csv(i, nrows=None if _file_in_range(i, "rain", from_date, to_date) else 0,
+                        **csv_options["rain"]) for i in files]
     data =  pd.concat(data, sort = False, ignore_index = True)
+    if (from_date is not None) or (to_date is not None):
+        data = _select_time(data, "rain", from_date, to_date)[0].reset_index(drop=True)
     if convert_time == True:
-        data["Begin"] = pd.to_datetime(data["Begin"], format="%d-%m-%Y %H:%M:%S")
-        data["Eind"] = pd.to_datetime(data["Eind"], format="%d-%m-%Y %H:%M:%S")
+        data["Begin"] = pd.to_datetime(data["Begin"], format=TIME_FORMAT)
+        data["Eind"] = pd.to_datetime(data["Eind"], format=TIME_FORMAT)
     
     data.rename({"Begin": "Start", "Eind": "End"}, axis=1, inplace = True)
     
@@ -218,48 +717,178 @@ def get_system_register(path):
 class sdf:
     """
     Will read all shp files from given path and store them within this class as data frames.
+    Every layer is read on first access only and kept afterwards, together with its
+    spatial index.
     ~~~ EXAMPLE CALL ~~~
     data = sdf("C:/mypath/aa-en-maas_sewer_shp")
     data.area_data
+    data.area_at([5.13], [51.68], crs="epsg:4326")
     ~~~~~~~~~~~~~~~~~~~~
     """
     def __init__(self, path):
+        self.path = path
+        self._layers = {}
+
+    def _layer(self, name):
+        """
+        Returns a layer, reading it and building its spatial index if necessary.
+        """
+        if name not in self._layers:
+            layer = getattr(self, "_read_" + name)()
+            # Accessing sindex builds the spatial index (STRtree) once, ahead of the lookups
+            _ = layer.sindex
+            self._layers[name] = layer
+        return self._layers[name]
+
+    def _read_area_data(self):
         # Sewage area data
-        area_data = gpd.read_file(path + "/" + "Rioleringsdeelgebied.shp")
+        area_data = gpd.read_file(self.path + "/" + "Rioleringsdeelgebied.shp")
         area_data["area"] = area_data.area
         area_data = area_data[["RGDIDENT", "NAAMRGD", "RGDID", "area", "geometry"]]
         area_data.columns = ["sewer_system", "area_name", "area_ID", "area", "geometry"]
-        
+        return area_data
+
+    def _read_RG_data(self):
         # RG data
-        RG_data = gpd.read_file(path + "/" + "Rioolgemaal.shp")
+        RG_data = gpd.read_file(self.path + "/" + "Rioolgemaal.shp")
         RG_data = RG_data[["ZRE_ID", "ZREIDENT", "ZRW_ZRW_ID", "ZRGCAPA1",
                                "ZRE_ZRE_ID", "ZRGRGCAP",
                                "ZRGGANGL", "geometry"]]
         RG_data.columns = ["unit_ID", "RG_ID", "RWZI_ID", "min_capacity", "to_unit_ID", "max_capacity",
                            "RG_name", "geometry"]
-        
+        return RG_data
+
+    def _read_RWZI_regions(self):
         # RWZI regions
-        RWZI_regions = gpd.read_file(path + "/" + "Zuiveringsregio.shp")
+        RWZI_regions = gpd.read_file(self.path + "/" + "Zuiveringsregio.shp")
         RWZI_regions = RWZI_regions[["GAGNAAM", "geometry"]]
         RWZI_regions.columns = ["RWZI_name", "geometry"]
-        
+        return RWZI_regions
+
+    def _read_RWZI_data(self):
         # RWZI data
-        RWZI_data = gpd.read_file(path + "/" + "RWZI.shp")
+        RWZI_data = gpd.read_file(self.path + "/" + "RWZI.shp")
         RWZI_data = RWZI_data[["ZRW_ID", "ZRWIDENT", "ZRWNAAM", "geometry"]]
         RWZI_data.columns = ["RWZI_ID", "RWZI_identifier", "RWZI_name", "geometry"]
-        
+        return RWZI_data
+
+    def _read_pipe_data(self):
         # Pipe data
-        pipe_data = gpd.read_file(path + "/" + "Leidingtrace.shp")
+        pipe_data = gpd.read_file(self.path + "/" + "Leidingtrace.shp")
         pipe_data = pipe_data[["LDG_ID", "IDENTIFICA", "TRACE_NAAM", "STATUS", "geometry"]]
         pipe_data.columns = ["LDG_ID", "LD_identifier", "LD_name", "status", "geometry"]
-        
-        
-        # Store data in class
-        self.area_data = area_data
-        self.RG_data = RG_data
-        self.RWZI_regions = RWZI_regions
-        self.RWZI_data = RWZI_data
-        self.pipe_data = pipe_data
+        return pipe_data
+
+    @property
+    def area_data(self):
+        return self._layer("area_data")
+
+    @property
+    def RG_data(self):
+        return self._layer("RG_data")
+
+    @property
+    def RWZI_regions(self):
+        return self._layer("RWZI_regions")
+
+    @property
+    def RWZI_data(self):
+        return self._layer("RWZI_data")
+
+    @property
+    def pipe_data(self):
+        return self._layer("pipe_data")
+
+    def _points(self, x, y, layer, crs=None):
+        """
+        Points of coordinates x, y (in crs, by default the one of the layer)
+        transformed to the crs of the layer.
+        """
+        points = gpd.GeoSeries(gpd.points_from_xy(x, y), crs=layer.crs if crs is None else crs)
+        return points.to_crs(layer.crs).values
+
+    def area_at(self, x, y, crs=None):
+        """
+        Returns the row of area_data that contains each point (x, y), NaN if the point
+        is in no area. Uses the spatial index of area_data instead of testing all areas.
+        """
+        points = self._points(x, y, self.area_data, crs)
+        point_index, area_index = self.area_data.sindex.query(points, predicate="intersects")
+
+        # Points on the border of two areas are assigned to the first one
+        order = np.lexsort((area_index, point_index))
+        point_index, area_index = point_index[order], area_index[order]
+        first = ~pd.Series(point_index).duplicated().values
+        areas = pd.Series(np.nan, index=range(len(points)))
+        areas.iloc[point_index[first]] = area_index[first]
+
+        return self.area_data.reindex(areas.values).reset_index(drop=True)
+
+    def nearest_pump(self, x, y, crs=None):
+        """
+        Returns the row of RG_data closest to each point (x, y).
+        """
+        points = self._points(x, y, self.RG_data, crs)
+        point_index, pump_index = self.RG_data.sindex.nearest(points, return_all=False)
+
+        return self.RG_data.iloc[pump_index[np.argsort(point_index)]].reset_index(drop=True)
+
+
+def _new_files(conn, files):
+    """
+    Returns the files (with size and modification time) that have not been
+    ingested into the database yet.
+    """
+    known = set(conn.execute("SELECT file, size, mtime FROM ingested_files").fetchall())
+    files = [(i, os.path.getsize(i), os.stat(i).st_mtime_ns) for i in files]
+    return [i for i in files if i not in known]
+
+
+def _sql_add_measurements(conn, folder):
+    """
+    Appends flow and level data of all new files in folder to the database.
+    """
+    new_files = _new_files(conn, [folder + "/" + i for i in sorted(os.listdir(folder))])
+    if len(new_files) == 0:
+        return
+    
+    data = _read_files([i[0] for i in new_files], "old_type", convert_time=True)
+    flow_data, level_data = _standardize_old_type(data)
+    
+    with conn:
+        for table, data in [("flow", flow_data), ("level", level_data)]:
+            data = data.assign(TimeStamp=data["TimeStamp"].dt.strftime("%Y-%m-%d %H:%M:%S"))
+            # Rows of re-exported (corrected) files replace the stored ones
+            conn.executemany("INSERT OR REPLACE INTO " + table + " (RG_ID, TimeStamp, Value, DataQuality) "
+                             "VALUES (?, ?, ?, ?)",
+                             data[["RG_ID", "TimeStamp", "Value", "DataQuality"]].itertuples(index=False))
+        conn.executemany("INSERT OR REPLACE INTO ingested_files VALUES (?, ?, ?)", new_files)
+
+
+def _sql_add_rain(conn, folder):
+    """
+    Appends rain data of all new files in folder to the database.
+    """
+    new_files = _new_files(conn, [folder + "/" + i for i in sorted(os.listdir(folder))])
+    if len(new_files) == 0:
+        return
+    
+    rain_data = _read_rain_files([i[0] for i in new_files])
+    rain_data = rain_data.drop_duplicates("Start", keep="last")
+    
+    with conn:
+        exists = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='rain'").fetchone()
+        if exists is None:
+            rain_data.to_sql("rain", conn, index=False, chunksize=10000)
+        else:
+            # Rows of re-exported (changed) files replace the stored hours
+            rain_data.to_sql("rain_new", conn, if_exists="replace", index=False, chunksize=10000)
+            columns = ", ".join('"' + i + '"' for i in rain_data.columns)
+            conn.execute("DELETE FROM rain WHERE Start IN (SELECT Start FROM rain_new)")
+            conn.execute("INSERT INTO rain (" + columns + ") SELECT " + columns + " FROM rain_new")
+            conn.execute("DROP TABLE rain_new")
+        conn.execute("CREATE INDEX IF NOT EXISTS rain_start ON rain (Start)")
+        conn.executemany("INSERT OR REPLACE INTO ingested_files VALUES (?, ?, ?)", new_files)
 
 
 def create_sql_db(path=None, data_path=None,
@@ -269,6 +898,11 @@ def create_sql_db(path=None, data_path=None,
         Function for generating an SQLite database consisting of measurement data
         and rain data. Other data sources are not integrated as their format is not
         supported by SQLite.
+        
+        The database is updated incrementally: files that have been ingested before
+        are skipped, so calling the function again only adds new exports. Files that
+        changed (size or modification time) are read again and replace the stored rows
+        of the same timestamps. Use query_sql_db to select data from it.
 
         ~~~~~ INPUT ~~~~~
         path      :   Path to directory where database should be created.
@@ -279,9 +913,10 @@ def create_sql_db(path=None, data_path=None,
                       folder does not have the same structure as original .zip.
         
         ~~~~~ DB STRUCTURE ~~~~~
-        "flow"    :   Flow data.
-        "level"   :   Level data.
-        "rain"    :   Rain data.
+        "flow"           :   Flow data, indexed on (RG_ID, TimeStamp).
+        "level"          :   Level data, indexed on (RG_ID, TimeStamp).
+        "rain"           :   Rain data, indexed on Start.
+        "ingested_files" :   Files already in the database.
 
         """
         
@@ -289,12 +924,26 @@ def create_sql_db(path=None, data_path=None,
         if path is None:
             path = os.getcwd()
         conn = sqlite3.connect(path + "/" + "sewer_data.db")
-    
-        # MEASUREMENT DATA
-        # Finding all pump names to be scraped
+        conn.execute("PRAGMA journal_mode=WAL")
+        
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS ingested_files "
+                         "(file TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)")
+            for table in ["flow", "level"]:
+                conn.execute("CREATE TABLE IF NOT EXISTS " + table +
+                             " (RG_ID INTEGER, TimeStamp TEXT, Value REAL, DataQuality INTEGER)")
+                conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS " + table + "_id_time ON " + table +
+                             " (RG_ID, TimeStamp)")
+        
         if data_path is not None:
+            measurement_path = data_path
+            rain_path = data_path
+        
+        # MEASUREMENT DATA
+        if measurement_path is not None:
+            # Finding all pump names to be scraped
             if pumps == "all":
-                files = os.listdir(data_path + "/sewer_data/data_pump")
+                files = os.listdir(measurement_path + "/sewer_data/data_pump")
                 folder_files = ["." not in i for i in files]
                 files = np.array(files)[folder_files]
             else:
@@ -302,34 +951,62 @@ def create_sql_db(path=None, data_path=None,
             
             # Loading pump data into sql
             for i in files:
-                flow_data, level_data = get_measurements(data_path + "/sewer_data/data_pump" + "/" + i + "/" + i)
-                flow_data.to_sql("flow", conn, if_exists="append", index=False)
-                level_data.to_sql("level", conn, if_exists="append", index=False)
-            
-            # RAIN DATA
-            rain_data = get_rain(data_path + "/sewer_data/rain_timeseries")
-            rain_data.to_sql("rain", conn, if_exists="replace", index=False)
+                _sql_add_measurements(conn, measurement_path + "/sewer_data/data_pump" + "/" + i + "/" + i)
         
-        else:
-            # MEASUREMENT DATA
-            if measurement_path is not None:
-                if pumps == "all":
-                    files = os.listdir(measurement_path + "/sewer_data/data_pump")
-                    folder_files = ["." not in i for i in files]
-                    files = np.array(files)[folder_files]
-                else:
-                    files = pumps
-                    
-                # Loading pump data into sql
-                for i in files:
-                    flow_data, level_data = get_measurements(measurement_path + "/sewer_data/data_pump" + "/" + i + "/" + i)
-                    flow_data.to_sql("flow", conn, if_exists="append", index=False)
-                    level_data.to_sql("level", conn, if_exists="append", index=False)
-            
-            # RAIN DATA
-            if rain_path is not None:
-                rain_data = get_rain(rain_path + "/sewer_data/rain_timeseries")
-                rain_data.to_sql("rain", conn, if_exists="replace", index=False)
+        # RAIN DATA
+        if rain_path is not None:
+            _sql_add_rain(conn, rain_path + "/sewer_data/rain_timeseries")
+        
+        conn.close()
+
+
+def query_sql_db(path=None, table="flow", RG_ID=None, from_date=None, to_date=None, columns=None):
+    """
+    Selects a time range from a database created by create_sql_db. Only the
+    selected rows are read, using the indexes of the tables.
+    ~~~ EXAMPLE CALL ~~~
+    flow_data = query_sql_db("C:/mypath", "flow", RG_ID=[8150, 8170],
+                             from_date="2019-01-01", to_date="2019-02-01")
+    ~~~~~~~~~~~~~~~~~~~~
+    
+    ~~~~~ INPUT ~~~~~
+    path      :   Directory of the database, the current directory by default.
+    table     :   "flow", "level" or "rain".
+    RG_ID     :   Pump or list of pumps. Ignored for rain. All pumps if None.
+    from_date :   Start of the time range (inclusive).
+    to_date   :   End of the time range (exclusive).
+    columns   :   Columns to select. All columns if None.
+    """
+    if path is None:
+        path = os.getcwd()
+    conn = sqlite3.connect(path + "/" + "sewer_data.db")
+    
+    time_column = "Start" if table == "rain" else "TimeStamp"
+    conditions, params = [], []
+    
+    if (RG_ID is not None) and (table != "rain"):
+        RG_ID = [RG_ID] if np.isscalar(RG_ID) else list(RG_ID)
+        conditions += ["RG_ID IN (" + ", ".join("?" * len(RG_ID)) + ")"]
+        params += [int(i) for i in RG_ID]
+    if from_date is not None:
+        conditions += ['"' + time_column + '" >= ?']
+        params += [str(pd.to_datetime(from_date))]
+    if to_date is not None:
+        conditions += ['"' + time_column + '" < ?']
+        params += [str(pd.to_datetime(to_date))]
+    
+    query = "SELECT " + ("*" if columns is None else ", ".join('"' + i + '"' for i in columns)) + \
+            " FROM " + table + \
+            ("" if len(conditions) == 0 else " WHERE " + " AND ".join(conditions))
+    
+    data = pd.read_sql_query(query, conn, params=params)
+    conn.close()
+    
+    for i in [time_column, "End"]:
+        if i in data.columns:
+            data[i] = pd.to_datetime(data[i])
+    
+    return data
 
 
 class get_file:   
@@ -340,54 +1017,255 @@ class get_file:
         return pickle.load(open(path + ".p", "rb" ))
 
 
+class get_cache:
+    """
+    Columnar cache for the outputs of load_all_pumps, get_measurements, get_rain and
+    get_rain_prediction. Data frames are stored as Parquet (needs pyarrow or fastparquet),
+    arrays as .npy files.
+
+    Every entry is keyed by the loader, its arguments and the names, sizes and
+    modification times of the files in the source directory. New or changed exports
+    therefore lead to a fresh entry and the outdated one is removed.
+
+    ~~~ EXAMPLE CALL ~~~
+    cache = get_cache("C:/mypath/cache")
+    level_data = cache.load(load_all_pumps, "C:/mypath/RG8180_L0", columns=["TimeStamp", "Value"])
+    pred_dates, pred_data = cache.load(get_rain_prediction, "C:/mypath/knmi....", reduce_grid=True)
+    ~~~~~~~~~~~~~~~~~~~~
+    """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.path = path
+
+    def key(self, loader, path, **kwargs):
+        """
+        Returns the name of the cache entry of loader(path, **kwargs).
+        """
+        call = json.dumps([loader.__name__, os.path.abspath(path), sorted(kwargs.items())], default=str)
+        files = [[i.name, i.stat().st_size, i.stat().st_mtime_ns]
+                 for i in sorted(os.scandir(path), key=lambda i: i.name) if i.is_file()]
+
+        call_key = hashlib.sha1(call.encode()).hexdigest()[:16]
+        file_key = hashlib.sha1(json.dumps(files).encode()).hexdigest()[:16]
+
+        return loader.__name__ + "_" + call_key + "_" + file_key
+
+    def load(self, loader, path, columns=None, **kwargs):
+        """
+        Returns loader(path, **kwargs) from the cache, if necessary the loader is run
+        and its output stored first. columns selects columns of all data frames.
+        """
+        key = self.key(loader, path, **kwargs)
+        entry = self.path + "/" + key
+
+        if not os.path.exists(entry):
+            self.save(loader(path, **kwargs), key)
+
+        parts = sorted(os.listdir(entry))
+        data = [pd.read_parquet(entry + "/" + i, columns=columns) if i.endswith(".parquet")
+                else np.load(entry + "/" + i) for i in parts]
+
+        # Loaders returning a single data frame are stored as a single part
+        return data[0] if parts == ["0.parquet"] else tuple(data)
+
+    def save(self, data, key):
+        """
+        Stores a data frame, an array or a tuple of those under key. Entries with the
+        same loader and arguments but other source files are removed. Other outputs
+        (e.g. None) raise a TypeError and nothing is stored.
+        """
+        if not isinstance(data, tuple):
+            data = (data,)
+
+        # Anything else would be stored as a pickled object array that cannot be loaded
+        for i in data:
+            if not (isinstance(i, pd.DataFrame) or (isinstance(i, np.ndarray) and i.dtype != object)):
+                raise TypeError("Cannot cache " + key + ": only data frames and numeric arrays "
+                                "can be stored, the loader returned " + type(i).__name__ + ".")
+
+        # Write to temporary folder first so that a failed write leaves no broken entry
+        temp = self.path + "/" + key + ".tmp"
+        if os.path.exists(temp):
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+
+        for i, j in enumerate(data):
+            if isinstance(j, pd.DataFrame):
+                j.to_parquet(temp + "/" + str(i) + ".parquet")
+            else:
+                np.save(temp + "/" + str(i) + ".npy", j)
+
+        for i in os.listdir(self.path):
+            if i.startswith(key.rsplit("_", 1)[0] + "_") and not i.endswith(".tmp"):
+                shutil.rmtree(self.path + "/" + i)
+
+        os.replace(temp, self.path + "/" + key)
+
+
+def _detect_data_format(path, files):
+    """
+    Returns the format of any data folder (measurements, rain, rain prediction),
+    None if it is unknown.
+    """
+    if _detect_format(path) is not None:
+        return _detect_format(path)
+    if any(i.endswith(".asc") for i in files):
+        return "rain_prediction"
+    if ("rain" in path) or ("knmi" in path):
+        return "rain"
+
+
+class data_catalog:
+    """
+    Scans a data directory once and stores a manifest of all folders holding data,
+    with their format, number of files, size and date range. Folders can then be
+    found by their name without searching the directory again.
+    ~~~ EXAMPLE CALL ~~~
+    catalog = data_catalog("D:/DC3")
+    level_bokhoven = load_all_pumps(catalog["RG8180_L0"])
+    catalog.manifest
+    ~~~~~~~~~~~~~~~~~~~~
+    
+    ~~~~~ INPUT ~~~~~
+    path          :   Data directory.
+    manifest_path :   File the manifest is stored in (csv). By default 'data_manifest.csv'
+                      within path. An existing manifest is used instead of scanning.
+    rescan        :   Scan path even if a manifest exists, e.g. after new exports arrived.
+    
+    If folders of the same name are nested (e.g. RG8150/RG8150), the innermost one is
+    used, as utility.search_for(..., last_instance=True) does.
+    """
+    def __init__(self, path, manifest_path=None, rescan=False):
+        if manifest_path is None:
+            manifest_path = os.path.join(path, "data_manifest.csv")
+        
+        if os.path.exists(manifest_path) and not rescan:
+            manifest = pd.read_csv(manifest_path, parse_dates=["from_date", "to_date"])
+        else:
+            manifest = self.scan(path)
+            manifest.to_csv(manifest_path, index=False)
+        
+        self.path = path
+        self.manifest_path = manifest_path
+        self.manifest = manifest
+        self._locations = dict(zip(manifest["tag"], manifest["path"]))
+    
+    @staticmethod
+    def scan(path):
+        """
+        Walks through path once and returns the manifest as a data frame.
+        """
+        manifest = []
+        for folder, _, files in os.walk(path):
+            data_format = _detect_data_format(folder.replace("\\", "/"), files)
+            files = [os.path.join(folder, i) for i in sorted(files)]
+            if (data_format is None) or (len(files) == 0):
+                continue
+            
+            if data_format == "rain_prediction":
+                dates = _prediction_files(folder)[1]["start"]
+                time_ranges = [(dates.min(), dates.max())]
+            else:
+                csv_format = "historian" if data_format == "historian_flow" else data_format
+                if csv_format != "old_type":
+                    files = [i for i in files if ".csv" in i]
+                time_ranges = [_file_time_range(i, csv_format) for i in files]
+                time_ranges = [i for i in time_ranges if i is not None]
+            
+            manifest.append({"tag": os.path.basename(folder),
+                             "path": folder,
+                             "format": data_format,
+                             "files": len(files),
+                             "MB": sum(os.path.getsize(i) for i in files) / 2**20,
+                             "from_date": min([i[0] for i in time_ranges], default=pd.NaT),
+                             "to_date": max([i[1] for i in time_ranges], default=pd.NaT)})
+        
+        # Sorting by depth lets the innermost of nested folders of the same name win
+        manifest = pd.DataFrame(manifest, columns=["tag", "path", "format", "files", "MB", "from_date", "to_date"])
+        depth = manifest["path"].str.count(r"[\\/]")
+        
+        return manifest.loc[depth.sort_values(kind="mergesort").index].reset_index(drop=True)
+    
+    def __getitem__(self, tag):
+        return self._locations[tag]
+    
+    def __contains__(self, tag):
+        return tag in self._locations
+
+
+def _tag_loader(tag):
+    """
+    Returns loader and its arguments for the folder tags used by get_db.
+    """
+    if "knmi.harmonie_2018-01-01_2019-08-29" in tag:
+        return get_rain, {"convert_time": True}
+    elif "rain_grid_prediction" in tag:
+        return get_rain_prediction, {"reduce_grid": True}
+    else:
+        return load_all_pumps, {"convert_time": True}
+
+
 class get_db:
     """
     This class can be used to automatically detect data in a given folder
-    and transform it into a pickled file. This is done at initialization.
+    and store it in a get_cache. This is done at initialization.
     
     ~~~~~ METHODS ~~~~~
     -- __init__()
     path           Location of the data.
     folder_tags    Names of folders that should be found from location.
-    dump_path      Where to dump pickled files in.
+    dump_path      Location of the cache.
     
     Returns None type object.
     
     -- load()
-    path           Where to load pickled files from.
-    tags           Names of pickled files.
+    path           Location of the cache.
+    tags           Names of the folders.
+    columns        Columns to load from the data frames (optional).
     
-    Returns tuple of data in order of tags.
+    Returns tuple of data in order of tags. Data of folders that changed since
+    initialization is reloaded automatically.
     
     ~~~~~ EXAMPLE CALLS ~~~~~
-    get_db(path=r"D:\DC3", folder_tags=["RG8180_L0", "data_pump_level"]) # Creating pickles
-    data = get_db.load(path=r"D:\DC3\Full Project", tags=["RG8180_L0", "data_pump_level"])
-    
-    (!) IMPORTANT NOTE: CURRENTLY STORING THE PICKLE IS CORRUPTED THUS THE
-    FUNCTION IS DEPRECATED.
+    get_db(path=r"D:\DC3", folder_tags=["RG8180_L0", "data_pump_level"], dump_path=r"D:\DC3\cache")
+    data = get_db.load(path=r"D:\DC3\cache", tags=["RG8180_L0", "data_pump_level"])
     """
     def __init__(self, path: str=None, folder_tags: list=None, dump_path: str=None):
         
-        # CREATE DIRECTORY IF IT DOESN'T EXIST
         if dump_path is None:
-            dump_path=""
-        else:
-            if not os.path.exists(dump_path):
-                os.makedirs(dump_path)
+            dump_path = os.getcwd()
+        cache = get_cache(dump_path)
         
         # GET FOLDER LOCATIONS OF TAGS
-        folder_locs = [utility.isolate_obj(utility.search_for(i, path, last_instance=True)) for i in folder_tags]
+        manifest_path = os.path.join(dump_path, "data_manifest.csv")
+        catalog = data_catalog(path, manifest_path=manifest_path)
         
-        # SAVE TAGGED DATA AS PICKLE
+        # Folders added after the manifest was written need a new scan
+        if not all(i in catalog for i in folder_tags):
+            catalog = data_catalog(path, manifest_path=manifest_path, rescan=True)
+        folder_locs = [catalog[i] for i in folder_tags]
+        
+        # STORE TAGGED DATA IN CACHE
         for i, j in zip(folder_locs, folder_tags):
-            if "knmi.harmonie_2018-01-01_2019-08-29" in j:
-                data = get_rain(i, convert_time=True)
-            elif "rain_grid_prediction" in j:
-                data = get_rain_prediction(i, reduce_grid=True)
-            else:
-                data = load_all_pumps(i, convert_time=True)
-
-            get_file().save(obj=data, path=dump_path + j)
+            loader, kwargs = _tag_loader(j)
+            cache.load(loader, i, **kwargs)
+        
+        # REMEMBER FOLDER LOCATIONS FOR load()
+        tag_file = os.path.join(dump_path, "tags.json")
+        tags = json.load(open(tag_file)) if os.path.exists(tag_file) else {}
+        tags.update(zip(folder_tags, folder_locs))
+        json.dump(tags, open(tag_file, "w"), indent=1)
     
-    def load(path: str, tags: list):
-        return tuple([get_file().load(path + "\\" + i) for i in tags])
\ No newline at end of file
+    @staticmethod
+    def load(path: str, tags: list, columns: list=None):
+        cache = get_cache(path)
+        folder_locs = json.load(open(os.path.join(path, "tags.json")))
+        
+        output = []
+        for i in tags:
+            loader, kwargs = _tag_loader(i)
+            output.append(cache.load(loader, folder_locs[i], columns=columns, **kwargs))
+        
+        return tuple(output)
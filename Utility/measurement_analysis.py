@@ -28,7 +28,7 @@ class measurement_analysis:
         level_data = wrangling.clean_mes_data(level_data)
 
         # Check if rain_data is already summarized
-        if not all(i in rain_data.columns for i in ['Date', 'Total', 'DrySeries']):
+        if "village_ID" in rain_data.columns or not all(i in rain_data.columns for i in ['Date', 'Total', 'DrySeries']):
             rain_data = wrangling.summarize_rain_data(rain_data, area_data, village_code, dry_threshold)
 
         # Adding basic variables to the data
@@ -58,7 +58,7 @@ class measurement_analysis:
         level_data["min"] = ((level_data["Value"].diff(1) < 0) & (level_data["Value"].diff(-1) < 0)).astype(int)
 
         # Calculate area in square-kilometres
-        self.area = area_data.loc[area_data["village_ID"] == village_code, "geometry"]\
+        self.area = area_data.loc[area_data["sewer_system"].str.slice(4,7) == village_code, "geometry"]\
                              .to_crs({"init": "epsg:3395"}).map(lambda p: p.area / 10**6).sum()
 
         # STORE DATA
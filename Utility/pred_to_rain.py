@@ -30,7 +30,7 @@ class pred_to_rain:
         area_data["y"] = area_data["geometry"].to_crs({'init': 'epsg:4326'}).centroid.y
 
         # Get grid indices for x and y coordinates
-        indices = wrangling.vec_cell_index(area_data["x"], area_data["y"], reduced=reduced)
+        indices = wrangling.cell_index(area_data["x"].values, area_data["y"].values, reduced=reduced)
         indices = list(zip(indices[0], indices[1]))
         area_data["loc"] = indices
 
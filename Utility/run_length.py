@@ -0,0 +1,95 @@
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ #
+# Objective: Vectorized primitives on runs of values,     #
+# such as dry day series or pump-on periods.              #
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ #
+
+import pandas as pd
+import numpy as np
+
+
+def _last_position(mask):
+    """
+    For every element, the position of the last True value of mask up to it
+    (0 if there is none).
+    """
+    return np.maximum.accumulate(np.where(mask, np.arange(len(mask)), 0))
+
+
+def reset_cumsum(lst, threshold=0, count=True):
+    """
+    Cummulative sum with reset at any value greater than or equal to the threshold.
+    Count being true means that the output will be a cummulative count (1-2-3-...)
+    otherwise its a normal cummulative sum. The first element is always 0.
+    """
+    values = np.asarray(lst, dtype=float)
+    reset = values >= threshold
+    if len(reset) > 0:
+        reset[0] = True
+
+    last_reset = _last_position(reset)
+    if count:
+        total = np.cumsum(~reset)
+        output = (total - total[last_reset]).astype(int)
+    else:
+        # Sums are taken per segment between resets, so a missing value only
+        # makes the rest of its own segment missing
+        missing = ~reset & np.isnan(values)
+        total = np.cumsum(np.where(reset | missing, 0, values))
+        n_missing = np.cumsum(missing)
+        output = total - total[last_reset]
+        output[n_missing - n_missing[last_reset] > 0] = np.nan
+
+    return pd.Series(output, index=getattr(lst, "index", None))
+
+
+def run_labels(active, label_first=True):
+    """
+    Labels consecutive runs of True values with 1, 2, 3, ... and all other values with 0.
+    If label_first is False, a run that is already going on at the first element is not
+    labelled, as its start is unknown.
+    """
+    active = np.asarray(active, dtype=bool)
+
+    # A run starts where an element is active and the previous is not
+    previous = np.concatenate([[not label_first], active[:-1]])
+    labels = np.cumsum(active & ~previous)
+    labels[~active] = 0
+
+    return labels
+
+
+def run_table(active, values=None, times=None, label_first=True):
+    """
+    Returns one row per run of True values in active.
+
+    ~~~~~ OUTPUT ~~~~~
+    group:     Label of the run as given by run_labels
+    start:     Position of the first element of the run
+    end:       Position of the last element of the run
+    length:    Number of elements in the run
+    sum:       Sum of values within the run (if values are given)
+    StartTime: Time of the first element (if times are given)
+    EndTime:   Time of the last element (if times are given)
+    TimeSpan:  Seconds between first and last element (if times are given)
+    """
+    labels = run_labels(active, label_first=label_first)
+    labelled = labels > 0
+
+    # Runs begin and end where the label changes
+    change = labels[1:] != labels[:-1]
+    start = np.where(labelled & np.concatenate([[True], change]))[0]
+    end = np.where(labelled & np.concatenate([change, [True]]))[0]
+
+    table = pd.DataFrame({"group": labels[start], "start": start, "end": end, "length": end - start + 1})
+
+    if values is not None:
+        total = np.concatenate([[0], np.cumsum(np.asarray(values, dtype=float))])
+        table["sum"] = total[end + 1] - total[start]
+
+    if times is not None:
+        times = pd.to_datetime(pd.Series(times).reset_index(drop=True))
+        table["StartTime"] = times.values[start]
+        table["EndTime"] = times.values[end]
+        table["TimeSpan"] = (table["EndTime"] - table["StartTime"]).dt.total_seconds()
+
+    return table
@@ -2,6 +2,7 @@ import os
 import pandas as pd
 import numpy as np
 import datetime
+import run_length
 
 
 def linearize_circle(p: float):
@@ -35,14 +36,7 @@ def reset_cumsum(lst, threshold=0, count=True):
     Count being true means that the output will be a cummulative count (1-2-3-...)
     otherwise its a normal cummulative sum.
     """
-    output = [0]
-    for i in range(1, len(lst)):
-        if count:
-            output = output + [0 if lst[i] >= threshold else output[i-1] + 1]
-        else:
-            output = output + [0 if lst[i] >= threshold else output[i-1] + lst[i]]
-
-    return pd.Series(output, index=lst.index)
+    return run_length.reset_cumsum(lst, threshold=threshold, count=count)
 
 
 def search_prior_indices(lst, adjacent_lst):
@@ -129,18 +123,20 @@ def search_for(x, start_path, last_instance=True):
     """
     Searches all folder for location with x in its name.
     Returned format is weird, so wrap this function with isolate_obj()
+    Walks the whole directory on every call, see load_files.data_catalog
+    for repeated lookups.
     """
     folders = listfold(start_path)
-    subpaths = [start_path + "\\" + i for i in listfold(start_path)]
+    subpaths = [os.path.join(start_path, i) for i in listfold(start_path)]
     
     if x not in folders:
         path = [search_for(x, i, last_instance) for i in subpaths]
 
     else:
-        path = start_path + "\\" + x
+        path = os.path.join(start_path, x)
         
         last_path_folders = listfold(path)
         if x in last_path_folders:
-            path = path + "\\" + x
+            path = os.path.join(path, x)
 
     return path
\ No newline at end of file
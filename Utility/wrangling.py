@@ -1,9 +1,8 @@
 import pandas as pd
 import numpy as np
-import utility
 from scipy.signal import find_peaks
-import datetime
-import utility
+from concurrent.futures import ProcessPoolExecutor
+import run_length
 
 rg_spots = \
 {"Drunen":            (51.680344, 5.132245),
@@ -18,38 +17,157 @@ rg_spots = \
  "Rompert":           (51.711202, 5.311724)}
 
 
-def clean_mes_data(df, convert_timestamp=True, sort_timestamp=True, remove_duplicates=True, select_quality=True):
-    if convert_timestamp:
-        if df["TimeStamp"].dtype != "<M8[ns]":
-            df["TimeStamp"] = pd.to_datetime(df["TimeStamp"])
+def clean_mes_data(df, convert_timestamp=True, sort_timestamp=True, remove_duplicates=True, select_quality=True,
+                   by=None, summary=False):
+    """
+    Sorts measurements by time, removes duplicate timestamps and measurements of bad
+    quality, in one stable pass. The input frame is not changed.
+
+    ~~~~~ INPUT  ~~~~~
+    df:      Measurements, e.g. from load_files.get_measurements or load_all_pumps
+    by:      Column to clean by, e.g. 'RG_ID' for frames of multiple pumps. Sorts by
+             (by, TimeStamp) and only removes duplicates within a pump.
+    summary: Also return the number of removed rows per pump (or in total when by is None)
+
+    ~~~~~ OUTPUT ~~~~~
+    df:      Cleaned measurements
+    summary: Data frame with the columns Rows, Duplicates, LowQuality and Kept
+    """
+    time = df["TimeStamp"]
+    if convert_timestamp and not pd.api.types.is_datetime64_any_dtype(time):
+        time = pd.to_datetime(time)
+
+    keys = [time.values] if by is None else [df[by].values, time.values]
 
+    # Stable order of the rows, by pump first
     if sort_timestamp:
-        df.sort_values("TimeStamp", inplace=True)
-        df.reset_index(drop=True, inplace=True)
+        order = np.lexsort(keys[::-1])
+    else:
+        order = np.arange(len(df))
 
+    duplicate = np.zeros(len(df), dtype=bool)
     if remove_duplicates:
-        df = df.loc[~df["TimeStamp"].duplicated()].reset_index(drop=True)
+        if sort_timestamp:
+            duplicate[1:] = np.logical_and.reduce([i[order][1:] == i[order][:-1] for i in keys])
+        else:
+            duplicate = pd.DataFrame({i: key for i, key in enumerate(keys)}).duplicated().values
 
+    low_quality = np.zeros(len(df), dtype=bool)
     if select_quality:
-        df = df.loc[df["DataQuality"] == 1].reset_index(drop=True)
+        low_quality = (df["DataQuality"].values[order] != 1) & ~duplicate
+
+    rows = order[~duplicate & ~low_quality]
+    output = df.take(rows)
+    if time is not df["TimeStamp"]:
+        output["TimeStamp"] = time.values[rows]
+    output = output.reset_index(drop=True)
+
+    if not summary:
+        return output
+
+    removed = pd.DataFrame({"Rows": 1,
+                            "Duplicates": duplicate,
+                            "LowQuality": low_quality,
+                            "Kept": ~duplicate & ~low_quality})
+    if by is None:
+        removed = removed.sum().to_frame().T
+    else:
+        removed = removed.groupby(df[by].values[order]).sum().rename_axis(by)
 
-    return df
+    return output, removed.astype(int)
 
 
-def merge_flow_level(flow_data, level_data):
-    # INTERPOLATION OF MISSING MEASUREMENTS
-    # Get all timestamps
-    unique_timestamps = pd.concat([flow_data["TimeStamp"], level_data["TimeStamp"]]).unique()
+def _align_sorted(flow_data, level_data):
+    """
+    Aligns flow and level data of a single pump, both sorted by time, on the union
+    of their timestamps. Returns both aligned frames and the union-index mapping.
+    """
+    flow_time = flow_data["TimeStamp"].values
+    level_time = level_data["TimeStamp"].values
+
+    # Merging two sorted runs, the stable sort is close to linear
+    union = np.concatenate([flow_time, level_time])
+    union.sort(kind="mergesort")
+    first = np.ones(len(union), dtype=bool)
+    first[1:] = union[1:] != union[:-1]
+    union = union[first]
+
+    flow_pos = np.searchsorted(union, flow_time)
+    level_pos = np.searchsorted(union, level_time)
+
+    aligned = []
+    for data, pos in [(flow_data, flow_pos), (level_data, level_pos)]:
+        data = data.drop(columns="TimeStamp").set_axis(pos, axis=0).reindex(range(len(union)))
+        data.insert(0, "TimeStamp", union)
+        aligned.append(data)
+
+    mapping = pd.DataFrame({"TimeStamp": union,
+                            "flow_row": -1,
+                            "level_row": -1})
+    mapping.loc[flow_pos, "flow_row"] = np.arange(len(flow_pos))
+    mapping.loc[level_pos, "level_row"] = np.arange(len(level_pos))
+
+    return aligned[0], aligned[1], mapping
+
+
+def align_flow_level(flow_data, level_data, by=None, return_index=False):
+    """
+    Aligns flow and level data on the union of their timestamps, without sorting
+    them again. Missing measurements are NaN.
+
+    ~~~~~ INPUT  ~~~~~
+    flow_data:    Flow data sorted by time (within each group), without duplicate timestamps,
+                  e.g. from clean_mes_data
+    level_data:   Level data of the same shape
+    by:           Column to group by, e.g. 'RG_ID' for frames of multiple pumps.
+                  Each pump is then aligned on its own timestamps.
+    return_index: Also return the union-index mapping: a frame with the aligned
+                  TimeStamp (and group) and the row of flow_data/level_data at each
+                  timestamp (-1 if there is none), which later stages can reuse.
+    """
+    if by is None:
+        flow_data, level_data, mapping = _align_sorted(flow_data, level_data)
+    else:
+        flow_groups = flow_data.groupby(by, sort=False).indices
+        level_groups = level_data.groupby(by, sort=False).indices
+        empty = np.array([], dtype=int)
 
-    # Add timestamps to index
-    flow_data = flow_data.set_index("TimeStamp").reindex(unique_timestamps)\
-                         .reset_index(drop=False).sort_values("TimeStamp").reset_index(drop=True)
-    level_data = level_data.set_index("TimeStamp").reindex(unique_timestamps)\
-                           .reset_index(drop=False).sort_values("TimeStamp").reset_index(drop=True)
+        aligned = []
+        for key in sorted(set(flow_groups) | set(level_groups)):
+            flow_rows = flow_groups.get(key, empty)
+            level_rows = level_groups.get(key, empty)
+            group = _align_sorted(flow_data.iloc[flow_rows], level_data.iloc[level_rows])
 
+            # Rows refer to the positions in the complete frames
+            mapping = group[2]
+            for column, rows in [("flow_row", flow_rows), ("level_row", level_rows)]:
+                mapping[column] = np.append(rows, -1)[mapping[column].values]
+
+            aligned.append([i.assign(**{by: key}) for i in group])
+
+        # Without any pump, the result keeps the columns of the empty frames
+        if len(aligned) == 0:
+            aligned.append([i.assign(**{by: flow_data[by].values[:0]}) for i in _align_sorted(flow_data, level_data)])
+
+        flow_data, level_data, mapping = [pd.concat([i[j] for i in aligned], ignore_index=True) for j in range(3)]
+        mapping = mapping[[by, "TimeStamp", "flow_row", "level_row"]]
+
+    if return_index:
+        return flow_data, level_data, mapping
     return flow_data, level_data
 
 
+def merge_flow_level(flow_data, level_data):
+    # INTERPOLATION OF MISSING MEASUREMENTS
+    # Data has to be sorted by time for the alignment
+    if not flow_data["TimeStamp"].is_monotonic_increasing:
+        flow_data = flow_data.sort_values("TimeStamp", kind="mergesort")
+    if not level_data["TimeStamp"].is_monotonic_increasing:
+        level_data = level_data.sort_values("TimeStamp", kind="mergesort")
+
+    return align_flow_level(flow_data, level_data)
+
+
 def fill_flow(flow_data):
     flow_data.loc[flow_data["Value"].isna() &\
                   (~flow_data["Value"].isna()).shift(1) &\
@@ -62,77 +180,268 @@ def fill_flow(flow_data):
     return flow_data
 
 
-def fill_level(level_data):
-    # Fill missing level data
-    na_indices = level_data.index[level_data["Value"].isna()]
-    non_na_indices = level_data.index[~level_data["Value"].isna()]
-
-    prior_indices = utility.search_prior_indices(na_indices, non_na_indices).reset_index(drop=True)
-    posterior_indices = utility.search_posterior_indices(na_indices, non_na_indices).reset_index(drop=True)
+def fill_level(level_data, by=None, edges=None):
+    """
+    Fills missing level values by linear interpolation in time between the previous
+    and next measured level.
 
-    # TimeStamps of prior and posterior indices
-    ts_prior = level_data.loc[prior_indices, "TimeStamp"]\
-                         .apply(lambda i: (i - datetime.datetime(2017,1,1)).total_seconds())\
-                         .reset_index(drop=True)
-    ts_posterior = level_data.loc[posterior_indices, "TimeStamp"]\
-                             .apply(lambda i: (i - datetime.datetime(2017,1,1)).total_seconds())\
-                             .reset_index(drop=True)
-    ts_actual = level_data.loc[level_data["Value"].isna(), "TimeStamp"]\
-                          .apply(lambda i: (i - datetime.datetime(2017,1,1)).total_seconds())\
-                          .reset_index(drop=True)
+    ~~~~~ INPUT  ~~~~~
+    level_data: Level data sorted by time (within each group), e.g. from merge_flow_level
+    by:         Column to group by, e.g. 'RG_ID' for a frame of multiple pumps.
+                Values are then only interpolated within a group.
+    edges:      Handling of missing values before the first or after the last measured
+                level. None leaves them missing, 'nearest' copies the closest measured level.
+    """
+    value = level_data["Value"].values.astype(float)
+    valid = ~np.isnan(value)
+    time = level_data["TimeStamp"].values.astype("datetime64[ns]").view(np.int64).astype(float)
+
+    # Positions of previous and next measured level, -1 / n if there is none
+    n = len(level_data)
+    positions = np.arange(n)
+    prior = np.where(valid, positions, -1)
+    posterior = np.where(valid, positions, n)
+    if by is None:
+        prior = np.maximum.accumulate(prior)
+        posterior = np.minimum.accumulate(posterior[::-1])[::-1]
+    else:
+        groups = level_data[by].values
+        prior = pd.Series(prior).groupby(groups).cummax().values
+        posterior = pd.Series(posterior[::-1]).groupby(groups[::-1]).cummin().values[::-1]
 
-    # Levels of prior and posterior indices
-    level_prior = level_data.loc[prior_indices, "Value"].reset_index(drop=True)
-    level_posterior = level_data.loc[posterior_indices, "Value"].reset_index(drop=True)
+    has_prior = prior >= 0
+    has_posterior = posterior < n
+    prior = np.where(has_prior, prior, 0)
+    posterior = np.where(has_posterior, posterior, 0)
 
     # Calculating weighted level values
-    fill_values = (level_prior*(ts_posterior-ts_actual) + level_posterior*(ts_actual-ts_prior)) /\
-                  (ts_posterior - ts_prior)
-    fill_values.index = level_data.index[level_data["Value"].isna()]
-    level_data["Value"] = level_data["Value"].fillna(fill_values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fill_values = (value[prior]*(time[posterior]-time) + value[posterior]*(time-time[prior])) /\
+                      (time[posterior] - time[prior])
+    fill_values[~(has_prior & has_posterior)] = np.nan
+
+    if edges == "nearest":
+        fill_values = np.where(has_prior & ~has_posterior, value[prior], fill_values)
+        fill_values = np.where(~has_prior & has_posterior, value[posterior], fill_values)
+
+    level_data["Value"] = np.where(valid, value, fill_values)
 
     return level_data
 
 
 def flow_group(flow):
-    lst = flow.copy()
+    """
+    Labels every run of non-zero flow (a flow peak) with 1, 2, 3, ... and zero flow with 0.
+    A peak already going on at the first measurement is not labelled.
+    """
+    return pd.Series(run_length.run_labels(flow != 0, label_first=False), index=flow.index)
+
+
+def _level_extrema(values, prominence=0.5, wlen=None, core=None):
+    """
+    Positions of level maxima and minima. If core (start, end) is given, only
+    extrema within it are returned.
+    """
+    maxima = find_peaks(values, prominence=prominence, wlen=wlen)[0]
+    minima = find_peaks(-values, prominence=prominence, wlen=wlen)[0]
+
+    if core is not None:
+        maxima = maxima[(maxima >= core[0]) & (maxima < core[1])]
+        minima = minima[(minima >= core[0]) & (minima < core[1])]
 
-    not_equal_0 = lst != 0
-    after_0 = lst.shift(1) == 0
-    not_equal_and_after_0 = not_equal_0 & after_0
-    not_equal_and_after_0 = not_equal_and_after_0.cumsum()
-    lst.loc[lst != 0] = not_equal_and_after_0.loc[lst != 0]
-    return lst.astype(int)
+    return maxima, minima
 
 
-def level_group(lst):
-    output = np.repeat(0, len(lst))
+def _chunk_extrema(values, offset, core, prominence, wlen):
+    """
+    Extrema of a chunk of the level series, as positions in the whole series.
+    """
+    maxima, minima = _level_extrema(values, prominence=prominence, wlen=wlen, core=core)
+    return maxima + offset, minima + offset
+
 
-    maxima = find_peaks(lst, prominence=0.5)[0]
-    minima = find_peaks(-lst, prominence=0.5)[0]
+def level_group(lst, prominence=0.5, chunk_size=None, overlap=17280, n_jobs=1):
+    """
+    Labels every level drop (from a maximum to the next minimum) with 1, 2, 3, ...
+    and all other measurements with 0. Maxima without a following minimum are ignored.
 
-    min_indices = list(map(lambda i: np.where(minima > i)[0][0], maxima))
+    ~~~~~ INPUT  ~~~~~
+    lst:        Level series
+    prominence: Minimum prominence of maxima and minima
+    chunk_size: If given, extrema are searched in chunks of chunk_size measurements,
+                each extended by overlap measurements on both sides.
+    overlap:    Measurements added to both sides of a chunk (default: one day of 5s data).
+                Prominence is then judged within overlap measurements of an extremum,
+                which equals the unchunked result with wlen=2*overlap+1.
+    n_jobs:     Number of processes for the chunks (None uses all cores).
+    """
+    values = np.asarray(lst, dtype=float)
+    n = len(values)
 
-    for i, j, k in zip(maxima, minima[min_indices], range(len(maxima))):
-        output[i:(j+1)] = k+1
+    if (chunk_size is None) or (chunk_size >= n):
+        maxima, minima = _level_extrema(values, prominence=prominence)
+    else:
+        wlen = 2 * overlap + 1
+        chunks = [(max(i - overlap, 0), i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+        args = [(values[a:min(c + overlap, n)], a, (b - a, c - a), prominence, wlen) for a, b, c in chunks]
+
+        if n_jobs == 1:
+            extrema = [_chunk_extrema(*i) for i in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                extrema = list(executor.map(_chunk_extrema, *zip(*args)))
+
+        maxima = np.concatenate([i[0] for i in extrema])
+        minima = np.concatenate([i[1] for i in extrema])
+
+    # Pair every maximum with the first minimum after it
+    following = np.searchsorted(minima, maxima, side="right")
+    maxima = maxima[following < len(minima)]
+    ends = minima[following[following < len(minima)]]
+
+    # A measurement belongs to the latest maximum before it if that drop has not ended yet
+    group = np.searchsorted(maxima, np.arange(n), side="right") - 1
+    in_drop = (group >= 0) & (ends[np.maximum(group, 0)] >= np.arange(n)) if len(maxima) > 0 \
+              else np.repeat(False, n)
+    output = np.where(in_drop, group + 1, 0)
 
     return pd.Series(output, index=lst.index)
 
 
+class grid_geometry:
+    """
+    Geometry of the KNMI rain prediction grid. Maps lon/lat coordinates to grid indices
+    in closed form, so arrays of coordinates are mapped at once.
+
+    ~~~~~ INPUT  ~~~~~
+    x_origin, x_size: Longitude of the western edge and width of a cell
+    y_origin, y_size: Latitude of the southern edge and height of a cell
+    n_cells:          Number of cells in both directions
+    x_offset:         Index of the first column of a reduced grid (91 for load_files.reduced_window)
+    y_offset:         Index of the first row of a reduced grid (101 for load_files.reduced_window)
+
+    ~~~ EXAMPLE CALL ~~~
+    x, y = knmi_grid.index(area_data["x"], area_data["y"])
+    """
+    def __init__(self, x_origin=-0.0185, x_size=0.037, y_origin=48.9885, y_size=0.023,
+                 n_cells=300, x_offset=0, y_offset=0):
+        self.x_origin = x_origin
+        self.x_size = x_size
+        self.y_origin = y_origin
+        self.y_size = y_size
+        self.n_cells = n_cells
+        self.x_offset = x_offset
+        self.y_offset = y_offset
+
+    def index(self, x, y):
+        """
+        Grid indices of the cells containing the coordinates (x = lon, y = lat).
+        Rows count from the north.
+        """
+        x_out = np.floor((np.asarray(x) - self.x_origin) / self.x_size).astype(int)
+        y_out = self.n_cells - np.ceil((np.asarray(y) - self.y_origin) / self.y_size).astype(int)
+
+        return x_out - self.x_offset, y_out - self.y_offset
+
+    def bounds(self, x_index, y_index):
+        """
+        Bounds (x_min, y_min, x_max, y_max) of the cells at the given indices, e.g.
+        for shapely.geometry.box.
+        """
+        x_index = np.asarray(x_index) + self.x_offset
+        y_index = self.n_cells - (np.asarray(y_index) + self.y_offset)
+
+        x_min = self.x_origin + x_index * self.x_size
+        y_min = self.y_origin + (y_index - 1) * self.y_size
+
+        return x_min, y_min, x_min + self.x_size, y_min + self.y_size
+
+    def windows(self, rain_grid, x, y, padding=1):
+        """
+        Gathers the (2 * padding + 1)-squared windows around all coordinates at once.
+        Returns an array of (coordinates, time, 2 * padding + 1, 2 * padding + 1),
+        indexed as rain_grid[:, x, y] like grid_area.
+        """
+        x_index, y_index = self.index(x, y)
+        steps = np.arange(-padding, padding + 1)
+
+        rows = np.atleast_1d(x_index)[:, None] + steps
+        columns = np.atleast_1d(y_index)[:, None] + steps
+
+        return np.moveaxis(rain_grid[:, rows[:, :, None], columns[:, None, :]], 1, 0)
+
+
+knmi_grid = grid_geometry()
+knmi_grid_reduced = grid_geometry(x_offset=91, y_offset=101)
+
+
 def cell_index(x, y, reduced=False):
-    x_space = np.linspace(start = -0.0185, stop = -0.0185 + 300*0.037, num = 301)
-    y_space = np.linspace(start = 48.9885, stop = 48.9885 + 300*0.023, num = 301)
+    """
+    Grid indices of lon/lat coordinates x and y, which can be scalars or arrays.
+    See grid_geometry.
+    """
+    return (knmi_grid_reduced if reduced else knmi_grid).index(x, y)
+
+vec_cell_index = cell_index
+
+
+def _summarize_rain(rain_data, membership, dry_threshold=0):
+    """
+    Daily rain totals for several groups of areas at once.
+
+    ~~~~~ INPUT  ~~~~~
+    rain_data:  File as gathered by load_files.get_rain(...)
+    membership: Data frame of area columns (index) by group (columns), with the weight
+                of every area in the mean of a group
+    """
+    start = rain_data["Start"]
+    if not pd.api.types.is_datetime64_any_dtype(start):
+        start = pd.to_datetime(start)
 
-    x_out = np.where(x >= x_space)[0][-1]
-    y_out = 300 - np.where(y <= y_space)[0][0]
+    # Average rainfall measurement of the areas in each group (unweighted by area size)
+    values = rain_data[membership.index].to_numpy(dtype=float)
+    observed = ~np.isnan(values)
+    weights = membership.to_numpy(dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = (np.where(observed, values, 0) @ weights) / (observed @ weights)
 
-    if reduced:
-        x_out = x_out - 91
-        y_out = y_out - 101
+    # Sum measurements by date and create dry-series column
+    daily = pd.DataFrame(total, columns=membership.columns).groupby(start.dt.floor("D").values).sum()
+    dry_series = daily.apply(lambda i: run_length.reset_cumsum(i, dry_threshold))
+
+    return pd.DataFrame({"village_ID": np.repeat(daily.columns.values, len(daily)),
+                         "Date": np.tile(daily.index.date, len(daily.columns)),
+                         "Total": daily.values.ravel(order="F"),
+                         "DrySeries": dry_series.values.ravel(order="F")})
 
-    return x_out, y_out
 
-vec_cell_index = np.vectorize(cell_index)
+def summarize_rain_villages(rain_data, area_data, village_codes=None, dry_threshold=0):
+    """
+    Daily rain summary of summarize_rain_data for every village at once. Neither input
+    is changed. The result can be passed to summarize_rain_data (and hence
+    measurement_analysis or generate_coefficient.to_dry_data) instead of the raw rain data.
+
+    ~~~~~ INPUT  ~~~~~
+    rain_data:     File as gathered by load_files.get_rain(...)
+    area_data:     File as gathered by load_files.sdf(...).area_data
+    village_codes: Villages to summarize (e.g. ['DRU']), all villages in area_data by default
+    dry_threshold: Minimum average rain per hour in the area that counts as wet
+
+    ~~~~~ OUTPUT ~~~~~
+    A data frame with the columns
+    village_ID: Village code
+    Date:       Date of measurement
+    Total:      Average rainfall measurement in the village's areas (unweighted by area size)
+    DrySeries:  Number of days since last rainfall.
+    """
+    in_rain = area_data["area_name"].isin(rain_data.columns)
+    membership = pd.crosstab(area_data.loc[in_rain, "area_name"].values,
+                             area_data.loc[in_rain, "sewer_system"].str.slice(4,7).values)
+    if village_codes is None:
+        village_codes = area_data["sewer_system"].str.slice(4,7).dropna().unique()
+    membership = membership.reindex(columns=village_codes, fill_value=0)
+
+    return _summarize_rain(rain_data, membership, dry_threshold)
 
 
 def summarize_rain_data(rain_data, area_data=None, village_code=None, dry_threshold=0):
@@ -140,7 +449,8 @@ def summarize_rain_data(rain_data, area_data=None, village_code=None, dry_thresh
     Function to reshape rain data to be fit for the DWAAS analysis.
 
     ~~~~~ INPUT  ~~~~~
-    rain_data:     File as gathered by load_files.get_rain(...)
+    rain_data:     File as gathered by load_files.get_rain(...), or the precomputed
+                   summary of summarize_rain_villages
     area_data:     File as gathered by load_files.sdf(...).area_data
     village_code:  Identifier of the pump (e.g. 'DRU' for Drunen)
     dry_threshold: Minimum average rain per hour in the area that counts as wet
@@ -152,96 +462,396 @@ def summarize_rain_data(rain_data, area_data=None, village_code=None, dry_thresh
     Total:     Average rainfall measurement in the area (unweighted by area size)
     DrySeries: Number of days since last rainfall.
     """
+    columns = ["Date", "Total", "DrySeries"]
 
-    # Convert to datetime if necessary
-    if rain_data["Start"].dtype != "<M8[ns]":
-            rain_data["Start"] = pd.to_datetime(rain_data["Start"])
-
-    # Sort data by time because of it being possibly unordered
-    rain_data.sort_values("Start", inplace=True)
-    rain_data.reset_index(drop=True, inplace=True)
+    # Select the village of a precomputed summary
+    if "village_ID" in rain_data.columns:
+        return rain_data.loc[rain_data["village_ID"] == village_code, columns].reset_index(drop=True)
 
     # Selects only data from certain right village_code
     if village_code is not None:
-        area_data["village_ID"] = area_data["sewer_system"].str.slice(4,7)
-        area_data = area_data.loc[area_data["village_ID"] == village_code]
-        areas = area_data["area_name"][area_data["area_name"].apply(lambda i: i in rain_data.columns)].to_list()
+        summary = summarize_rain_villages(rain_data, area_data, [village_code], dry_threshold)
+    else:
+        areas = rain_data.drop(columns=["Start", "End"]).select_dtypes("number").columns
+        summary = _summarize_rain(rain_data, pd.DataFrame(1, index=areas, columns=[None]), dry_threshold)
 
-        rain_data = rain_data.loc[:, ["Start", "End"] + areas]
+    return summary[columns]
 
-    # Create date column and sum up rain measurements over all area
-    rain_data["Date"] = rain_data["Start"].apply(lambda i: i.date())
-    rain_data["Total"] = rain_data.iloc[:, 2:].mean(axis=1)
 
-    # Sum measurements by date and create dry-series column
-    rain_data = rain_data.groupby("Date")["Total"].sum().reset_index(drop=False)
-    rain_data["DrySeries"] = utility.reset_cumsum(rain_data["Total"], dry_threshold)
+def grid_area(rain_grid, rg: str, padding=1, reduced=False):
+    """
+    Window of the rain grid around the location of rg (see rg_spots).
+    """
+    return grid_areas(rain_grid, [rg], padding=padding, reduced=reduced)[0]
 
-    return rain_data
 
+def grid_areas(rain_grid, rgs=None, padding=1, reduced=False):
+    """
+    Windows of the rain grid around several locations of rg_spots, gathered at once.
 
-def grid_area(rain_grid, rg: str, padding=1, reduced=False):
-    
-    x, y = cell_index(rg_spots[rg][1], rg_spots[rg][0], reduced=reduced)
-    
-    coords = (x - padding, x + padding, y - padding, y + padding)
-    print(coords)
-    
-    return rain_grid[:, coords[0]:(coords[1]+1), coords[2]:(coords[3]+1)]
+    ~~~~~ INPUT  ~~~~~
+    rain_grid: Grid of rain predictions (time x rows x columns)
+    rgs:       Names in rg_spots, all by default
+    padding:   Number of cells around the location
+    reduced:   Whether rain_grid is the reduced window
+
+    ~~~~~ OUTPUT ~~~~~
+    Array of (rgs, time, 2 * padding + 1, 2 * padding + 1)
+    """
+    if rgs is None:
+        rgs = list(rg_spots)
 
+    lat, lon = np.array([rg_spots[rg] for rg in rgs]).T
 
-def flow_by_hour(df, impute_range=False):
+    return (knmi_grid_reduced if reduced else knmi_grid).windows(rain_grid, lon, lat, padding=padding)
+
+
+def _split_flow(flow_data, freq, label):
+    """
+    Distributes the volume and covered time of every measurement interval over the
+    buckets it overlaps. Flow is assumed constant within an interval.
+    """
+    end = flow_data["TimeStamp"]
+    start = end - pd.to_timedelta(flow_data["TimeSpan"], unit="s")
+    base = start.min().floor(freq)
+
+    # Cumulative volume and covered time are linear within an interval, hence
+    # their values at the bucket edges can be interpolated exactly
+    x = np.column_stack([(start - base).dt.total_seconds(), (end - base).dt.total_seconds()]).ravel()
+    volume = np.cumsum(flow_data["Flow"].values)
+    volume = np.column_stack([volume - flow_data["Flow"].values, volume]).ravel()
+    covered = np.cumsum(flow_data["TimeSpan"].values)
+    covered = np.column_stack([covered - flow_data["TimeSpan"].values, covered]).ravel()
+
+    edges = pd.date_range(base, end.max().floor(freq) + pd.tseries.frequencies.to_offset(freq), freq=freq)
+    x_edges = (edges - base).total_seconds().values
+
+    buckets = pd.DataFrame({label: edges[:-1],
+                            "Flow": np.diff(np.interp(x_edges, x, volume)),
+                            "TimeSpan": np.diff(np.interp(x_edges, x, covered))})
+
+    # Data quality stays the mean of the measurements ending within a bucket
+    quality = flow_data.groupby(end.dt.floor(freq))["DataQuality"].mean()
+    buckets["DataQuality"] = quality.reindex(buckets[label]).values
+
+    return buckets.loc[buckets["TimeSpan"] > 0, [label, "Flow", "DataQuality", "TimeSpan"]]
+
+
+def resample_flow(df, freq="h", by=None, split_intervals=False, impute_range=False,
+                  max_span=None, label="TimeHour"):
+    """
+    Integrates flow measurements (m3/h) to volume per time bucket.
+
+    ~~~~~ INPUT  ~~~~~
+    df:              Flow data with columns 'TimeStamp', 'Value', 'DataQuality', sorted by time
+                     (within each group)
+    freq:            Bucket size, e.g. '5min', '15min', 'h', 'D'
+    by:              Column to group by, e.g. 'RG_ID' for a frame of multiple pumps
+    split_intervals: If True, intervals between measurements that cross a bucket edge are
+                     split over the buckets. Otherwise a measurement's full interval is
+                     counted in the bucket of its TimeStamp.
+    impute_range:    Adds missing buckets between the first and last bucket (of each group)
+                     with zero flow and data quality.
+    max_span:        Maximum seconds a single measurement may account for (gaps are capped).
+    label:           Name of the bucket column.
+
+    ~~~~~ OUTPUT ~~~~~
+    One row per bucket (and group) with the columns
+    Flow:        Volume in the bucket
+    DataQuality: Mean data quality of the measurements in the bucket
+    TimeSpan:    Seconds covered by measurements in the bucket
+    """
     flow_data = df.copy()
-    
-    # 
-    flow_data["TimeSpan"] = flow_data["TimeStamp"].diff(1).apply(lambda i: i.seconds).fillna(5)
-    flow_data["TimeHour"] = flow_data["TimeStamp"].apply(lambda i: i.replace(minute=0, second=0))
+    keys = [] if by is None else [by]
+
+    # Seconds since previous measurement, the first measurement accounts for 5 seconds
+    timestamps = flow_data["TimeStamp"] if by is None else flow_data.groupby(by)["TimeStamp"]
+    flow_data["TimeSpan"] = timestamps.diff(1).dt.total_seconds().fillna(5)
+    if max_span is not None:
+        flow_data["TimeSpan"] = flow_data["TimeSpan"].clip(upper=max_span)
     flow_data["Flow"] = flow_data["Value"] / 3600 * flow_data["TimeSpan"]
-    
-    # 
-    flow_data = flow_data.groupby("TimeHour").aggregate({"Flow": np.sum, "DataQuality": np.mean, "TimeSpan": np.sum})
-    
+
+    if split_intervals:
+        if by is None:
+            flow_data = _split_flow(flow_data, freq, label)
+        else:
+            flow_data = pd.concat([_split_flow(group, freq, label).assign(**{by: key})
+                                   for key, group in flow_data.groupby(by)], ignore_index=True)
+    else:
+        flow_data[label] = flow_data["TimeStamp"].dt.floor(freq)
+        flow_data = flow_data.groupby(keys + [label])\
+                             .aggregate({"Flow": "sum", "DataQuality": "mean", "TimeSpan": "sum"})\
+                             .reset_index(drop=False)
+
     if impute_range:
-        dt_range = pd.date_range(flow_data.index[0].floor('h'), flow_data.index[-1].floor('h'), freq='h')
-        flow_data = flow_data.reindex(dt_range)
+        if by is None:
+            full_index = pd.date_range(flow_data[label].min(), flow_data[label].max(), freq=freq, name=label)
+            flow_data = flow_data.set_index(label).reindex(full_index)
+        else:
+            ranges = flow_data.groupby(by)[label].agg(["min", "max"])
+            full_index = pd.concat([pd.DataFrame({by: i, label: pd.date_range(j["min"], j["max"], freq=freq)})
+                                    for i, j in ranges.iterrows()])
+            flow_data = flow_data.set_index([by, label]).reindex(pd.MultiIndex.from_frame(full_index))
         flow_data["Flow"] = flow_data["Flow"].fillna(0)
         flow_data["DataQuality"] = flow_data["DataQuality"].fillna(0)
-    
-    return flow_data.reset_index(drop=False).rename(columns={"index": "TimeHour"})
+        flow_data = flow_data.reset_index(drop=False)
 
+    return flow_data[keys + [label, "Flow", "DataQuality", "TimeSpan"]].reset_index(drop=True)
 
-def match_by_timestamp(rain_prediction, other_data, multiple=False, steps=3):
+
+def flow_by_hour(df, impute_range=False):
     """
-    
+    Volume of flow per hour, see resample_flow.
+    """
+    return resample_flow(df, freq="h", impute_range=impute_range)
+
+
+class hourly_pipeline:
+    """
+    Incremental version of clean_mes_data -> merge_flow_level -> fill_flow -> flow_by_hour
+    for measurements that keep arriving. Only new readings are passed to update, which
+    returns the hourly rows that changed. Per pump it keeps the last processed timestamp
+    and flow value, the last level and the open hour bucket.
+
+    Readings are processed up to the latest timestamp present in both the flow and level
+    data of a pump (the flow data only, when use_level is False). The hourly rows then
+    equal those of a full recompute on the history up to that time. Readings at or before
+    an already received timestamp of the same pump are dropped.
+
+    ~~~ EXAMPLE CALL ~~~
+    pipeline = hourly_pipeline()
+    updated_rows = pipeline.update(new_flow_data, new_level_data)
+    """
+    def __init__(self, use_level=True):
+        self.use_level = use_level
+        self.state = {}
+
+    @staticmethod
+    def _new_state():
+        return {"flow_seen": None,
+                "level_seen": None,
+                "flow": pd.DataFrame({"TimeStamp": pd.Series(dtype="datetime64[ns]"),
+                                      "Value": pd.Series(dtype=float),
+                                      "DataQuality": pd.Series(dtype=float)}),
+                "level": pd.DataFrame({"TimeStamp": pd.Series(dtype="datetime64[ns]"),
+                                       "Value": pd.Series(dtype=float)}),
+                "time": None,
+                "value": np.nan,
+                "level_value": np.nan,
+                "pending": 0.0,
+                "bucket": None}
+
+    @staticmethod
+    def _receive(state, stream, data):
+        """
+        Adds new readings of one stream to the buffer of a pump, cleaned like clean_mes_data.
+        """
+        data = data.assign(TimeStamp=pd.to_datetime(data["TimeStamp"]))
+        if state[stream + "_seen"] is not None:
+            data = data.loc[data["TimeStamp"] > state[stream + "_seen"]]
+        if len(data) == 0:
+            return
+        state[stream + "_seen"] = data["TimeStamp"].max()
+
+        data = clean_mes_data(data, convert_timestamp=False)
+        state[stream] = pd.concat([state[stream], data[state[stream].columns]], ignore_index=True)
+
+    @staticmethod
+    def _process(state, watermark):
+        """
+        Processes the buffered readings up to watermark. Returns the changed hour buckets.
+        """
+        flow = state["flow"].loc[state["flow"]["TimeStamp"] <= watermark]
+        level = state["level"].loc[state["level"]["TimeStamp"] <= watermark]
+        state["flow"] = state["flow"].iloc[len(flow):]
+        state["level"] = state["level"].iloc[len(level):]
+        if len(level) > 0:
+            state["level_value"] = level["Value"].iloc[-1]
+
+        # Union of the timestamps, as merge_flow_level
+        times = np.union1d(flow["TimeStamp"].values, level["TimeStamp"].values)
+        if len(times) == 0:
+            return None
+        positions = np.searchsorted(times, flow["TimeStamp"].values)
+        value = np.full(len(times), np.nan)
+        value[positions] = flow["Value"].values
+        quality = np.full(len(times), np.nan)
+        quality[positions] = flow["DataQuality"].values
+
+        # Seconds since previous measurement, the first measurement accounts for 5 seconds
+        prior_time = times[0] - np.timedelta64(5, "s") if state["time"] is None else state["time"]
+        span = np.diff(np.concatenate([[prior_time], times])) / np.timedelta64(1, "s")
+
+        # Filling as fill_flow, a missing value at the end counts as 0 until the next row arrives
+        valid = ~np.isnan(value)
+        prior_value = np.concatenate([[state["value"]], value[:-1]])
+        prior_valid = ~np.isnan(prior_value)
+        next_valid = np.concatenate([valid[1:], [False]])
+        filled = np.where(valid, value, np.where(prior_valid & next_valid, prior_value, 0))
+
+        buckets = pd.DataFrame({"TimeHour": times.astype("datetime64[h]").astype("datetime64[ns]"),
+                                "Flow": filled / 3600 * span,
+                                "Quality": np.nan_to_num(quality),
+                                "Count": ~np.isnan(quality),
+                                "TimeSpan": span})
+
+        changed = state["bucket"] is not None and (buckets["TimeHour"].iloc[0] == state["bucket"]["TimeHour"].iloc[0])
+        if state["bucket"] is not None and valid[0] and state["pending"] != 0:
+            state["bucket"]["Flow"] += state["pending"]
+            changed = True
+        if changed:
+            buckets = pd.concat([state["bucket"], buckets], ignore_index=True)
+
+        buckets = buckets.groupby("TimeHour", sort=True).sum().reset_index(drop=False)
+
+        state["time"] = times[-1]
+        state["value"] = value[-1]
+        state["pending"] = prior_value[-1] * span[-1] / 3600 if not valid[-1] and prior_valid[-1] else 0.0
+        state["bucket"] = buckets.iloc[[-1]].reset_index(drop=True)
+
+        return buckets
+
+    def update(self, flow_data, level_data=None):
+        """
+        Processes new flow (and level) readings of one or more pumps.
+
+        ~~~~~ INPUT  ~~~~~
+        flow_data:  New flow measurements with the columns 'RG_ID', 'TimeStamp', 'Value', 'DataQuality'
+        level_data: New level measurements of the same shape
+
+        ~~~~~ OUTPUT ~~~~~
+        The changed hourly rows with the columns RG_ID, TimeHour, Flow, DataQuality, TimeSpan
+        as flow_by_hour. Rows of a later update replace those of an earlier one.
+        """
+        streams = [("flow", flow_data)]
+        if self.use_level and level_data is not None:
+            streams.append(("level", level_data))
+
+        for stream, data in streams:
+            for key, group in data.groupby("RG_ID", sort=False):
+                state = self.state.setdefault(key, self._new_state())
+                self._receive(state, stream, group)
+
+        output = []
+        for key, state in self.state.items():
+            watermark = state["flow_seen"]
+            if self.use_level and watermark is not None and state["level_seen"] is not None:
+                watermark = min(watermark, state["level_seen"])
+            elif self.use_level:
+                continue
+            if watermark is None:
+                continue
+
+            buckets = self._process(state, watermark)
+            if buckets is not None:
+                output.append(buckets.assign(RG_ID=key))
+
+        if len(output) == 0:
+            return pd.DataFrame(columns=["RG_ID", "TimeHour", "Flow", "DataQuality", "TimeSpan"])
+
+        output = pd.concat(output, ignore_index=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            output["DataQuality"] = output["Quality"] / output["Count"]
+
+        return output[["RG_ID", "TimeHour", "Flow", "DataQuality", "TimeSpan"]]
+
+
+def _match_indices(rain_prediction, other_data, multiple=False, steps=3):
+    """
+    Integer indices in the rain prediction and the matching hours of other_data.
+    With multiple, hours without a complete history of steps predictions are left out.
     """
-    # Omitting all negative rain predictions
-    rain_prediction[1][rain_prediction[1] < 0] = 0
-    
     if multiple:
         bool_1 = np.sum([(other_data["TimeHour"]-pd.Timedelta(hours=i)).isin(rain_prediction[0]["start"].shift(i))
                          for i in range(steps)]
                         , axis=0) > 1
         other_data_indices = other_data["TimeHour"][bool_1]
-        
+
     else:
         bool_1 = other_data["TimeHour"].isin(rain_prediction[0]["start"])
         other_data_indices = other_data["TimeHour"][bool_1]
-    
+
     # Select common TimeStamps
     shared_indices = np.intersect1d(rain_prediction[0]["start"].values, other_data_indices.values)
-    
+
     # Get integer indices to use for rain_prediction
-    rp_indices = rain_prediction[0]["start"].reset_index(drop=False)\
+    rp_indices = rain_prediction[0]["start"].reset_index(drop=True)\
+                                            .reset_index(drop=False)\
                                             .set_index("start")\
                                             .reindex(shared_indices).values.flatten()
-    
+
+    if multiple:
+        complete = rp_indices >= steps - 1
+        rp_indices, shared_indices = rp_indices[complete], shared_indices[complete]
+
+    return rp_indices, shared_indices
+
+
+def _lag_windows(grid, multiple=False, steps=3):
+    """
+    View of the rain grid as (time, cells), or with multiple as (time, cells, steps)
+    windows ending at each time. No data is copied for contiguous grids.
+    """
+    flat = grid.reshape(grid.shape[0], -1)
     if multiple:
-        grid = np.stack([rain_prediction[1][rp_indices-i] for i in range(steps)])
-    
-        grid = grid.reshape(grid.shape[0], grid.shape[1], grid.shape[2] * grid.shape[3])
-        grid = np.concatenate(grid, axis=1)
+        return np.lib.stride_tricks.sliding_window_view(flat, steps, axis=0)
+    return flat
+
+
+def _lag_batch(windows, rp_indices, multiple=False, steps=3):
+    """
+    Copies the rows at rp_indices out of the windows, as (rows, steps * cells) with the
+    most recent prediction first. Negative rain predictions are set to 0.
+    """
+    if multiple:
+        batch = windows[rp_indices - steps + 1][:, :, ::-1]
+        batch = batch.transpose(0, 2, 1).reshape(len(rp_indices), -1)
     else:
-        grid = rain_prediction[1][rp_indices]
-        grid = grid.reshape(grid.shape[0], grid.shape[1] * grid.shape[2])
-    
-    return grid, other_data.set_index("TimeHour").reindex(shared_indices).reset_index(drop=False)
+        batch = windows[rp_indices]
+
+    # Omitting all negative rain predictions
+    return np.maximum(batch, 0, out=batch)
+
+
+def match_by_timestamp(rain_prediction, other_data, multiple=False, steps=3):
+    """
+    Selects the rain prediction grids and the rows of other_data for the hours
+    present in both. The input grid is not changed.
+
+    ~~~~~ INPUT  ~~~~~
+    rain_prediction: Tuple of the prediction dates (column 'start') and the grid
+                     of predictions (time x rows x columns)
+    other_data:      Data with a 'TimeHour' column, e.g. from flow_by_hour
+    multiple:        Use the predictions of the last steps hours as features
+    steps:           Number of hours used with multiple
+
+    ~~~~~ OUTPUT ~~~~~
+    grid:            Array of (hours, [steps *] cells)
+    other_data:      Rows of other_data of the same hours
+    """
+    rp_indices, shared_indices = _match_indices(rain_prediction, other_data, multiple, steps)
+    windows = _lag_windows(rain_prediction[1], multiple, steps)
+
+    return _lag_batch(windows, rp_indices, multiple, steps), \
+           other_data.set_index("TimeHour").reindex(shared_indices).reset_index(drop=False)
+
+
+def iter_match_by_timestamp(rain_prediction, other_data, multiple=False, steps=3, batch_size=4096):
+    """
+    Generator version of match_by_timestamp, yielding (grid, other_data) blocks of at most
+    batch_size hours. Only the current block is copied out of the rain grid, which
+    keeps memory flat for many lags or a memory-mapped grid (load_rain_prediction).
+
+    ~~~ EXAMPLE CALL ~~~
+    for X_batch, y_batch in iter_match_by_timestamp(rain_prediction, flow_data_by_hour,
+                                                    multiple=True, steps=12):
+        ...
+    """
+    rp_indices, shared_indices = _match_indices(rain_prediction, other_data, multiple, steps)
+    windows = _lag_windows(rain_prediction[1], multiple, steps)
+    other_data = other_data.set_index("TimeHour")
+
+    for start in range(0, len(rp_indices), batch_size):
+        indices = rp_indices[start:start + batch_size]
+        yield _lag_batch(windows, indices, multiple, steps), \
+              other_data.reindex(shared_indices[start:start + batch_size]).reset_index(drop=False)
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import data_imputation
+
+
+def _pump(rg, n, seed):
+    rng = np.random.default_rng(seed)
+    time = pd.date_range("2019-01-01", periods=n, freq="5s")
+    level_data = pd.DataFrame({"RG_ID": rg, "TimeStamp": time,
+                               "Value": np.round(np.sin(np.arange(n) / 40), 2), "DataQuality": 1})
+    measured = rng.random(n) < 0.6
+    flow_data = pd.DataFrame({"RG_ID": rg, "TimeStamp": time[measured],
+                              "Value": rng.exponential(30, measured.sum()), "DataQuality": 1})
+    return flow_data, level_data
+
+
+def test_fill_flow_partitioned_matches_fill_flow():
+    flow_data, level_data = _pump(8150, 2000, 0)
+
+    expected = data_imputation.fill_flow(flow_data, level_data)
+    output = data_imputation.fill_flow_partitioned(flow_data, level_data, block_size=300, n_jobs=1)
+
+    np.testing.assert_allclose(output.values, expected.values)
+    assert output.index.name == "TimeStamp"
+
+
+def test_fill_flow_partitioned_pump_without_level_data():
+    flow_data, level_data = _pump(8150, 500, 1)
+    other_flow_data, _ = _pump(8170, 300, 2)
+    other_flow_data.loc[::7, "Value"] = np.nan
+
+    output = data_imputation.fill_flow_partitioned(pd.concat([flow_data, other_flow_data]), level_data,
+                                                   by="RG_ID", n_jobs=1)
+
+    assert output.index.names == ["RG_ID", "TimeStamp"]
+    np.testing.assert_allclose(output.loc[8150].values,
+                               data_imputation.fill_flow(flow_data, level_data).values)
+    np.testing.assert_array_equal(output.loc[8170].values, other_flow_data["Value"].values)
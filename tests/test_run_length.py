@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+import run_length
+
+
+def test_reset_cumsum_sum_recovers_after_missing_value():
+    values = pd.Series([5, 1, np.nan, 1, 5, 1, 2, 5, 1])
+
+    output = run_length.reset_cumsum(values, threshold=3, count=False)
+
+    expected = [0, 1, np.nan, np.nan, 0, 1, 3, 0, 1]
+    np.testing.assert_array_equal(output.values, expected)
+
+
+def test_reset_cumsum_count():
+    values = pd.Series([5, 1, np.nan, 1, 5, 1])
+
+    output = run_length.reset_cumsum(values, threshold=3)
+
+    assert output.tolist() == [0, 1, 2, 3, 0, 1]
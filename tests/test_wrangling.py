@@ -0,0 +1,34 @@
+import pandas as pd
+
+import wrangling
+
+
+def _measurements(n, rg=8150, start="2019-01-01"):
+    return pd.DataFrame({"RG_ID": rg,
+                         "TimeStamp": pd.date_range(start, periods=n, freq="5s"),
+                         "Value": 1.0,
+                         "DataQuality": 1})
+
+
+def test_merge_flow_level_empty_input():
+    empty = _measurements(0)
+
+    flow_data, level_data = wrangling.merge_flow_level(empty, empty)
+
+    assert len(flow_data) == 0 and len(level_data) == 0
+    assert list(flow_data.columns) == ["TimeStamp", "RG_ID", "Value", "DataQuality"]
+
+
+def test_merge_flow_level_one_side_empty():
+    flow_data, level_data = wrangling.merge_flow_level(_measurements(3), _measurements(0))
+
+    assert len(flow_data) == 3 and len(level_data) == 3
+    assert level_data["Value"].isna().all()
+
+
+def test_align_flow_level_by_pump_with_empty_input():
+    empty = _measurements(0)
+
+    flow_data, level_data, mapping = wrangling.align_flow_level(empty, empty, by="RG_ID", return_index=True)
+
+    assert len(flow_data) == 0 and len(mapping) == 0